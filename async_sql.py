@@ -0,0 +1,52 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import sql
+
+# Все обращения к базе идут через один поток: запись в SQLite и так
+# сериализуется, а event loop больше не ждёт fsync.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql")
+
+
+def _to_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _executor, functools.partial(func, *args, **kwargs)
+        )
+
+    return wrapper
+
+
+def shutdown():
+    _executor.submit(sql.close_connections).result()
+
+
+init_db = _to_async(sql.init_db)
+add_user = _to_async(sql.add_user)
+confirm_user = _to_async(sql.confirm_user)
+is_confirmed = _to_async(sql.is_confirmed)
+get_confirmed_users = _to_async(sql.get_confirmed_users)
+get_recipients_for_sender = _to_async(sql.get_recipients_for_sender)
+get_recipient_contacts = _to_async(sql.get_recipient_contacts)
+get_user_contact = _to_async(sql.get_user_contact)
+update_distribution_status = _to_async(sql.update_distribution_status)
+update_distribution_statuses = _to_async(sql.update_distribution_statuses)
+set_sender_status = _to_async(sql.set_sender_status)
+toggle_distribution_status = _to_async(sql.toggle_distribution_status)
+take_letters_for_recipient = _to_async(sql.take_letters_for_recipient)
+schedule_notifications = _to_async(sql.schedule_notifications)
+get_due_notifications = _to_async(sql.get_due_notifications)
+get_next_notification_due = _to_async(sql.get_next_notification_due)
+complete_notifications = _to_async(sql.complete_notifications)
+postpone_notifications = _to_async(sql.postpone_notifications)
+delete_notifications = _to_async(sql.delete_notifications)
+enqueue_campaign = _to_async(sql.enqueue_campaign)
+get_campaign_chats = _to_async(sql.get_campaign_chats)
+record_delivery = _to_async(sql.record_delivery)
+get_campaign_progress = _to_async(sql.get_campaign_progress)
+get_stats = _to_async(sql.get_stats)
+get_pending_letters_page = _to_async(sql.get_pending_letters_page)
+get_recipient_contacts_by_sender = _to_async(sql.get_recipient_contacts_by_sender)
@@ -0,0 +1,152 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+import show_distribution  # noqa: E402
+import sql  # noqa: E402
+from distribute import (  # noqa: E402
+    create_distribution,
+    create_distribution_array,
+    save_distribution_array,
+    verify_distribution,
+    verify_distribution_array,
+)
+
+SIZES = (100, 10_000, 100_000)
+KS = (3, 10)
+
+# Разница меньше этой считается шумом даже при большом относительном росте
+NOISE_FLOOR = 0.002
+
+
+def best_of(repeat: int, func, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def show_report():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        show_distribution.main()
+
+
+def populate_users(user_ids):
+    sql.init_db()
+    with sql.transaction() as conn:
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name, confirmed) VALUES (?, ?, ?, 1)",
+            ((user_id, f"user{user_id}", f"User{user_id}") for user_id in user_ids),
+        )
+
+
+def bench(sizes, ks, repeat: int, tmp: Path):
+    results = {}
+    for n in sizes:
+        sql.close_connections()
+        sql.DB_NAME = str(tmp / f"users_{n}.db")
+        user_ids = list(range(1, n + 1))
+        users = [(user_id, f"User{user_id}", "") for user_id in user_ids]
+        populate_users(user_ids)
+
+        for k in ks:
+            if k >= n:
+                continue
+            rng = np.random.default_rng(k)
+            senders, receivers = create_distribution_array(user_ids, k, rng=rng)
+            distribution = dict(zip(senders.tolist(), receivers.tolist()))
+            stages = {
+                "create": lambda: create_distribution_array(user_ids, k, rng=rng),
+                "create_dict": lambda: create_distribution(users, k),
+                "verify": lambda: verify_distribution_array(senders, receivers),
+                "verify_dict": lambda: verify_distribution(distribution),
+                "save": lambda: save_distribution_array(senders, receivers),
+                "show_stats": show_distribution.calculate_stats,
+                "show_report": show_report,
+            }
+            for stage, func in stages.items():
+                key = f"{stage}/n={n}/k={k}"
+                results[key] = best_of(repeat, func)
+                print(f"{key:<28} {results[key] * 1000:>10.2f} мс", flush=True)
+    sql.close_connections()
+    return results
+
+
+def compare(results, baseline, threshold: float):
+    regressions = []
+    for key, seconds in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        ratio = seconds / base if base else float("inf")
+        flag = ratio > 1 + threshold and seconds - base > NOISE_FLOOR
+        if flag:
+            regressions.append(key)
+        print(
+            f"{key:<28} {base * 1000:>10.2f} → {seconds * 1000:>10.2f} мс  "
+            f"x{ratio:.2f}{'  РЕГРЕССИЯ' if flag else ''}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк жеребьёвки: создание, проверка, сохранение, отчёт")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)))
+    parser.add_argument("--ks", default=",".join(map(str, KS)))
+    parser.add_argument("--repeat", type=int, default=3, help="Берётся лучший из повторов")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON с базовыми результатами")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое замедление, доля")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = bench(
+            [int(n) for n in args.sizes.split(",")],
+            [int(k) for k in args.ks.split(",")],
+            args.repeat,
+            Path(tmp),
+        )
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(
+                {
+                    "meta": {
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "sqlite": sqlite3.sqlite_version,
+                        "machine": platform.machine(),
+                    },
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())["results"]
+        print("\nСравнение с базовым прогоном:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nРегрессий: {len(regressions)}")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
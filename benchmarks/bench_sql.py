@@ -0,0 +1,89 @@
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sql  # noqa: E402
+
+
+def legacy_get_user_contact(user_id: int):
+    conn = sqlite3.connect(sql.DB_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT first_name, last_name, username FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+
+def legacy_update_distribution_status(sender_id: int, recipient_id: int, status: int):
+    conn = sqlite3.connect(sql.DB_NAME)
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE distribution SET status = ?
+        WHERE telegram_id_sender = ? AND telegram_id_recipient = ?
+    """, (status, sender_id, recipient_id))
+    conn.commit()
+    conn.close()
+
+
+def uncached_get_user_contact(user_id: int):
+    # Сбрасываем запись кэша, чтобы сравнивать с connect-per-call именно
+    # чтение из базы через пул, а не попадания в кэш.
+    sql.invalidate_contact(user_id)
+    return sql.get_user_contact(user_id)
+
+
+def populate(users: int, k: int):
+    sql.init_db()
+    with sql.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name, confirmed) VALUES (?, ?, ?, 1)",
+            ((i, f"user{i}", f"User{i}") for i in range(users)),
+        )
+        conn.executemany(
+            "INSERT INTO distribution (telegram_id_sender, telegram_id_recipient) VALUES (?, ?)",
+            ((i, (i + j) % users) for i in range(users) for j in range(1, k + 1)),
+        )
+
+
+def measure(name: str, func, calls: int):
+    start = time.perf_counter()
+    for i in range(calls):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<45} {calls / elapsed:>12.0f} вызовов/с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение connect-per-call и пула соединений")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sql.DB_NAME = str(Path(tmp) / "users.db")
+        populate(args.users, 3)
+        n = args.users
+
+        measure("get_user_contact: connect-per-call", lambda i: legacy_get_user_contact(i % n), args.calls)
+        measure("get_user_contact: пул", lambda i: uncached_get_user_contact(i % n), args.calls)
+        measure("get_user_contact: пул + кэш", lambda i: sql.get_user_contact(i % n), args.calls)
+        measure(
+            "update_distribution_status: connect-per-call",
+            lambda i: legacy_update_distribution_status(i % n, (i % n + 1) % n, i % 2),
+            args.calls,
+        )
+        measure(
+            "update_distribution_status: пул",
+            lambda i: sql.update_distribution_status(i % n, (i % n + 1) % n, i % 2),
+            args.calls,
+        )
+        sql.close_connections()
+
+
+if __name__ == "__main__":
+    main()
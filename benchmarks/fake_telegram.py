@@ -0,0 +1,117 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe, GetUpdates
+from aiogram.types import Chat, Message, Update, User
+
+BOT_USER = User(id=1, is_bot=True, first_name="Bot", username="fake_bot")
+
+
+class FakeSession(BaseSession):
+    # Сессия бота без сети: запоминает вызовы Bot API и возвращает
+    # правдоподобные ответы. latency имитирует время ответа Telegram.
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: List[tuple] = []
+        self.listeners: List[Callable[[str, Any, float], None]] = []
+        self._updates: Optional[asyncio.Queue] = None
+        self._message_id = 0
+
+    @property
+    def updates(self) -> asyncio.Queue:
+        # Очередь для getUpdates в режиме polling
+        if self._updates is None:
+            self._updates = asyncio.Queue()
+        return self._updates
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None):
+        if isinstance(method, GetUpdates):
+            return await self._get_updates(method)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        now = time.perf_counter()
+        self.calls.append((name, chat_id, now))
+        for listener in self.listeners:
+            listener(name, chat_id, now)
+
+        if isinstance(method, GetMe):
+            return BOT_USER
+        if method.__returning__ is Message:
+            self._message_id += 1
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=int(chat_id), type="private"),
+                from_user=BOT_USER,
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def _get_updates(self, method: GetUpdates):
+        try:
+            first = await asyncio.wait_for(self.updates.get(), method.timeout or 0.1)
+        except TimeoutError:
+            return []
+        updates = [first]
+        while len(updates) < (method.limit or 100) and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError("FakeSession не поддерживает скачивание файлов")
+        yield b""  # делает метод асинхронным генератором, как в BaseSession
+
+    async def close(self):
+        pass
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": (
+                [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+                if text.startswith("/")
+                else []
+            ),
+        },
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER.model_dump(exclude_none=True),
+                "text": "...",
+            },
+        },
+    }
+
+
+def as_update(payload: Dict[str, Any]) -> Update:
+    return Update.model_validate(payload)
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import async_sql  # noqa: E402
+import sql  # noqa: E402
+from distribute import create_distribution_array, save_distribution_array  # noqa: E402
+from fake_telegram import FakeSession, as_update, callback_update, message_update  # noqa: E402
+
+os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+
+import main  # noqa: E402
+
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+# Доли типов апдейтов: сканирование QR, отметка получателя, подтверждение
+MIX = {"start": 0.2, "toggle": 0.6, "confirm": 0.2}
+
+USER_OFFSET = 10_000
+
+
+class TimingExecutor(ThreadPoolExecutor):
+    # Подменяет исполнитель async_sql и считает время, которое запросы
+    # провели в потоке базы (без ожидания в очереди).
+    def __init__(self):
+        super().__init__(max_workers=1, thread_name_prefix="sql")
+        self.calls = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def timed():
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.calls += 1
+                    self.busy += elapsed
+
+        return super().submit(timed)
+
+
+def build_database(users: int, k: int, seed: int):
+    sql.init_db()
+    user_ids = list(range(USER_OFFSET, USER_OFFSET + users))
+    with sql.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name, confirmed) VALUES (?, ?, ?, 1)",
+            ((user_id, f"user{user_id}", f"User{user_id}") for user_id in user_ids),
+        )
+    senders, receivers = create_distribution_array(user_ids, k, rng=np.random.default_rng(seed))
+    save_distribution_array(senders, receivers)
+    return dict(zip(senders.tolist(), receivers.tolist()))
+
+
+def make_updates(distribution, count: int, seed: int):
+    rng = random.Random(seed)
+    senders = list(distribution)
+    kinds = rng.choices(list(MIX), weights=list(MIX.values()), k=count)
+    updates = []
+    for update_id, kind in enumerate(kinds, start=1):
+        user_id = rng.choice(senders)
+        if kind == "start":
+            payload = message_update(update_id, user_id, "/start corporate26")
+        elif kind == "toggle":
+            recipient_id = rng.choice(distribution[user_id])
+            payload = callback_update(update_id, user_id, f"toggle_{recipient_id}")
+        else:
+            payload = callback_update(update_id, user_id, "confirm_letters")
+        updates.append((kind, as_update(payload)))
+    return updates
+
+
+async def run(updates, concurrency: int):
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(kind, update):
+        async with semaphore:
+            start = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            latencies[kind].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(feed(kind, update) for kind, update in updates))
+    return time.perf_counter() - start, latencies
+
+
+def summarize(values):
+    q = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return {
+        "count": len(values),
+        "p50_ms": q[49] * 1000,
+        "p95_ms": q[94] * 1000,
+        "p99_ms": q[98] * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def report(result):
+    print(
+        f"Апдейтов: {result['updates']} за {result['elapsed_s']:.2f} с, "
+        f"{result['throughput']:.0f} апд/с"
+    )
+    for kind, stats in result["latency"].items():
+        print(
+            f"  {kind:<8} {stats['count']:>7}  p50 {stats['p50_ms']:>7.2f} мс  "
+            f"p95 {stats['p95_ms']:>7.2f} мс  p99 {stats['p99_ms']:>7.2f} мс  "
+            f"max {stats['max_ms']:>7.2f} мс"
+        )
+    db = result["db"]
+    print(
+        f"База: {db['calls']} вызовов, {db['busy_s']:.2f} с "
+        f"({db['busy_share'] * 100:.0f}% времени), {db['mean_ms']:.3f} мс на вызов"
+    )
+    print(f"Вызовов Bot API: {result['api_calls']}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочный прогон хендлеров бота через dp.feed_update без Telegram"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременно обрабатываемых апдейтов")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Имитация ответа Bot API, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Сохранить результат в файл")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sql.DB_NAME = str(Path(tmp) / "users.db")
+        distribution = build_database(args.users, args.k, args.seed)
+        updates = make_updates(distribution, args.updates, args.seed)
+
+        session = FakeSession(latency=args.api_latency / 1000)
+        main.bot.session = session
+        executor = TimingExecutor()
+        async_sql._executor = executor
+
+        elapsed, latencies = asyncio.run(run(updates, args.concurrency))
+        # Закрытие соединений ниже в замер не входит
+        db_calls, db_busy = executor.calls, executor.busy
+
+        executor.submit(sql.close_connections).result()
+        executor.shutdown()
+        sql.close_connections()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        "users": args.users,
+        "k": args.k,
+        "updates": len(updates),
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "throughput": len(updates) / elapsed,
+        "latency": {
+            "all": summarize(all_latencies),
+            **{kind: summarize(values) for kind, values in sorted(latencies.items())},
+        },
+        "db": {
+            "calls": db_calls,
+            "busy_s": db_busy,
+            "busy_share": db_busy / elapsed,
+            "mean_ms": db_busy / max(1, db_calls) * 1000,
+        },
+        "api_calls": len(session.calls),
+    }
+    report(result)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
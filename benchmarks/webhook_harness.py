@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import sql  # noqa: E402
+from fake_telegram import FakeSession, as_update, message_update  # noqa: E402
+
+# Токен нужен только для валидации при создании Bot: сеть подменена FakeSession
+os.environ.setdefault("BOT_TOKEN", "123456:harness")
+
+import main  # noqa: E402
+
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = "harness"
+
+# Лог на каждый апдейт заметно искажает замер
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+
+class ReplyTracker:
+    # Задержка апдейта — от отправки до первого вызова Bot API в этот чат,
+    # то есть до момента, когда пользователь увидел бы ответ.
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.sent: dict[int, float] = {}
+        self.latencies: list[float] = []
+        self.done = asyncio.Event()
+
+    def __call__(self, name, chat_id, now):
+        started = self.sent.pop(chat_id, None)
+        if started is None:
+            return
+        self.latencies.append(now - started)
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+
+def populate(count: int, offset: int, k: int = 3):
+    # Участники с жеребьёвкой, чтобы /start corporate26 доставал из базы
+    # реальный список получателей, как при сканировании QR на корпоративе
+    sql.init_db()
+    users = range(offset, offset + count)
+    with sql.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name, confirmed) VALUES (?, ?, ?, 1)",
+            ((user_id, f"user{user_id}", f"User{user_id}") for user_id in users),
+        )
+        conn.executemany(
+            "INSERT INTO distribution (telegram_id_sender, telegram_id_recipient) VALUES (?, ?)",
+            (
+                (user_id, offset + (user_id - offset + j) % count)
+                for user_id in users
+                for j in range(1, k + 1)
+            ),
+        )
+
+
+def make_updates(count: int, offset: int):
+    populate(count, offset)
+    return [message_update(offset + i, offset + i, "/start corporate26") for i in range(count)]
+
+
+async def run_webhook(session: FakeSession, updates, concurrency: int, timeout: float):
+    tracker = ReplyTracker(len(updates))
+    session.listeners = [tracker]
+    server = TestServer(main.build_webhook_app(WEBHOOK_PATH, secret=WEBHOOK_SECRET), access_log=None)
+    await server.start_server()
+    url = str(server.make_url(WEBHOOK_PATH))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(client, payload):
+        async with semaphore:
+            tracker.sent[payload["message"]["chat"]["id"]] = time.perf_counter()
+            async with client.post(
+                url, json=payload, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+            ) as response:
+                response.raise_for_status()
+
+    start = time.perf_counter()
+    try:
+        async with ClientSession() as client:
+            await asyncio.gather(*(post(client, payload) for payload in updates))
+        await asyncio.wait_for(tracker.done.wait(), timeout)
+        return time.perf_counter() - start, tracker.latencies
+    finally:
+        await server.close()
+
+
+async def run_polling(session: FakeSession, updates, timeout: float):
+    tracker = ReplyTracker(len(updates))
+    session.listeners = [tracker]
+    polling = asyncio.create_task(
+        main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False, polling_timeout=1)
+    )
+    start = time.perf_counter()
+    try:
+        for payload in updates:
+            tracker.sent[payload["message"]["chat"]["id"]] = time.perf_counter()
+            session.updates.put_nowait(as_update(payload))
+        await asyncio.wait_for(tracker.done.wait(), timeout)
+        return time.perf_counter() - start, tracker.latencies
+    finally:
+        await main.dp.stop_polling()
+        await polling
+
+
+def report(mode: str, elapsed: float, latencies):
+    q = statistics.quantiles(latencies, n=100)
+    print(
+        f"{mode:<8} апдейтов {len(latencies):>6}  {len(latencies) / elapsed:>8.0f} апд/с  "
+        f"p50 {q[49] * 1000:>7.1f} мс  p95 {q[94] * 1000:>7.1f} мс  "
+        f"p99 {q[98] * 1000:>7.1f} мс  max {max(latencies) * 1000:>7.1f} мс"
+    )
+
+
+async def run(args):
+    session = FakeSession(latency=args.api_latency / 1000)
+    main.bot.session = session
+    modes = ["webhook", "polling"] if args.mode == "both" else [args.mode]
+    for index, mode in enumerate(modes):
+        # У каждого прогона свои пользователи, чтобы прогоны не мешали друг другу
+        updates = make_updates(args.updates, offset=1_000_000 * (index + 1))
+        if mode == "webhook":
+            elapsed, latencies = await run_webhook(session, updates, args.concurrency, args.timeout)
+        else:
+            elapsed, latencies = await run_polling(session, updates, args.timeout)
+        report(mode, elapsed, latencies)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Задержка обработки апдейтов в режимах webhook и polling без обращения к Telegram"
+    )
+    parser.add_argument("--mode", choices=("webhook", "polling", "both"), default="both")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременных POST-запросов")
+    parser.add_argument("--api-latency", type=float, default=50.0, help="Имитация ответа Bot API, мс")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sql.DB_NAME = str(Path(tmp) / "users.db")
+        asyncio.run(run(args))
+        sql.close_connections()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Iterable, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+import async_sql
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram для рассылок: около 30 сообщений в секунду на бота
+# и не чаще одного сообщения в секунду в один чат.
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+CONCURRENCY = 10
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        bot,
+        rate: float = GLOBAL_RATE,
+        per_chat_interval: float = PER_CHAT_INTERVAL,
+        concurrency: int = CONCURRENCY,
+        max_attempts: int = MAX_ATTEMPTS,
+        on_result: Optional[Callable[[int, bool, Optional[str]], Awaitable[None]]] = None,
+        on_retry_after: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.on_result = on_result
+        self.on_retry_after = on_retry_after
+        self._last_sent: dict[int, float] = {}
+
+    async def _wait_for_chat(self, chat_id: int):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> Tuple[bool, Optional[str]]:
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return True, None
+            except TelegramRetryAfter as e:
+                error = str(e)
+                logger.warning(f"Flood control, пауза {e.retry_after} сек (чат {chat_id})")
+                self.bucket.pause(e.retry_after)
+                if self.on_retry_after is not None:
+                    await self._callback(self.on_retry_after, chat_id, e.retry_after)
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+                logger.warning(
+                    f"Ошибка при отправке пользователю {chat_id} "
+                    f"(попытка {attempt}/{self.max_attempts}): {error}"
+                )
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(delay)
+            except Exception as e:
+                return False, str(e)
+        return False, error
+
+    async def _callback(self, callback, *args):
+        # Колбэки пишут журнал в базу; их ошибка не должна ронять воркер,
+        # иначе gather отдаст исключение, а остальные воркеры продолжат без владельца.
+        try:
+            await callback(*args)
+        except Exception:
+            logger.exception(f"Ошибка в {callback.__name__} для чата {args[0]}")
+
+    async def _worker(self, messages, kwargs, counters):
+        for chat_id, text in messages:
+            ok, error = await self.send(chat_id, text, **kwargs)
+            counters[0 if ok else 1] += 1
+            if ok:
+                logger.info(f"Сообщение отправлено пользователю {chat_id}")
+            else:
+                logger.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {error}")
+            if self.on_result is not None:
+                await self._callback(self.on_result, chat_id, ok, error)
+
+    async def run(self, messages: Iterable[Tuple[int, str]], **kwargs) -> Tuple[int, int]:
+        # Все воркеры читают из одного итератора, поэтому сообщения можно
+        # генерировать лениво и не держать всю рассылку в памяти.
+        messages = iter(messages)
+        counters = [0, 0]
+        await asyncio.gather(
+            *(self._worker(messages, kwargs, counters) for _ in range(self.concurrency))
+        )
+        return counters[0], counters[1]
+
+
+async def run_campaign(
+    bot,
+    campaign: str,
+    messages: Iterable[Tuple[int, str]],
+    retry_failed: bool = False,
+    audience: Optional[Iterable[int]] = None,
+    **kwargs,
+) -> Tuple[int, int]:
+    # Журнал доставки в broadcast_log позволяет перезапустить рассылку:
+    # уже доставленные сообщения пропускаются, упавшие — по флагу retry_failed.
+    # audience — все chat_id рассылки: они заранее пишутся в журнал как
+    # pending, чтобы --status показывал, сколько осталось. Сами тексты
+    # генерируются лениво.
+    finished = set(
+        await async_sql.get_campaign_chats(
+            campaign, ("sent",) if retry_failed else ("sent", "failed")
+        )
+    )
+    total = None
+    if audience is not None:
+        audience = [chat_id for chat_id in audience if chat_id not in finished]
+        await async_sql.enqueue_campaign(campaign, audience)
+        total = len(audience)
+    logger.info(
+        f"Рассылка {campaign!r}: к отправке {'?' if total is None else total}, "
+        f"уже обработано {len(finished)}"
+    )
+    messages = ((chat_id, text) for chat_id, text in messages if chat_id not in finished)
+
+    done = 0
+
+    async def on_result(chat_id: int, ok: bool, error: Optional[str]):
+        nonlocal done
+        done += 1
+        if done % 50 == 0 or done == total:
+            logger.info(f"Рассылка {campaign!r}: [{done}/{'?' if total is None else total}]")
+        await async_sql.record_delivery(campaign, chat_id, "sent" if ok else "failed", error)
+
+    async def on_retry_after(chat_id: int, retry_after: int):
+        await async_sql.record_delivery(
+            campaign, chat_id, "retry_after", retry_at=time.time() + retry_after
+        )
+
+    broadcaster = Broadcaster(bot, on_result=on_result, on_retry_after=on_retry_after)
+    return await broadcaster.run(messages, **kwargs)
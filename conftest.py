@@ -0,0 +1,11 @@
+import pytest
+
+import sql
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(sql, "DB_NAME", str(tmp_path / "users.db"))
+    sql.init_db()
+    yield
+    sql.close_connections()
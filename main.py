@@ -2,28 +2,51 @@ import asyncio
 import logging
 import os
 import random
+import secrets
+import time
+from typing import Optional, Tuple
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
+    BufferedInputFile,
     CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Message,
 )
+from aiohttp import web
 from dotenv import load_dotenv
 
-from sql import (
+from async_sql import (
     add_user,
     confirm_user,
     init_db,
     is_confirmed,
+    shutdown as shutdown_db,
+    get_recipient_contacts,
     get_recipients_for_sender,
     get_user_contact,
-    update_distribution_status,
+    set_sender_status,
+    toggle_distribution_status,
     take_letters_for_recipient,
-    get_pending_letters,
+    get_pending_letters_page,
+    schedule_notifications,
+    get_due_notifications,
+    get_next_notification_due,
+    complete_notifications,
+    postpone_notifications,
+    delete_notifications,
+    get_stats,
 )
+import metrics
+import profiling
+import sql
+from broadcast import GLOBAL_RATE, TokenBucket
+from middlewares import ConcurrencyLimitMiddleware, HandlerTimingMiddleware
+from sql import contact_cache_stats, format_contact
 
 load_dotenv()
 
@@ -34,23 +57,193 @@ logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# polling или webhook. Для webhook WEBHOOK_URL — публичный адрес, на который
+# Telegram шлёт апдейты; без него сервер поднимается, но вебхук не регистрируется.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Без секрета любой, кто узнал адрес, может прислать апдейт от имени админа.
+# Если вебхук регистрирует сам бот, секрет генерируется при запуске и
+# передаётся в set_webhook; при ручной регистрации WEBHOOK_SECRET обязателен.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    secrets.token_urlsafe(32) if WEBHOOK_URL else None
+)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "64"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+
+# Метрики в формате Prometheus отдаются отдельным сервером, если задан
+# METRICS_PORT. Авторизации у них нет, поэтому по умолчанию он слушает
+# только localhost, а не публичный адрес вебхука.
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Диагностика: порог журнала медленных запросов и блокировки цикла событий,
+# в миллисекундах; 0 — выключено.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+LOOP_LAG_MS = float(os.getenv("LOOP_LAG_MS", "0"))
+PROFILE_MAX_SECONDS = 600
+
+if SLOW_QUERY_MS:
+    sql.SLOW_QUERY_MS = SLOW_QUERY_MS
+
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+concurrency_limit = ConcurrencyLimitMiddleware(HANDLER_CONCURRENCY)
+dp.update.outer_middleware(concurrency_limit)
+
+handler_timing = HandlerTimingMiddleware(metrics.HANDLER_LATENCY)
+dp.message.middleware(handler_timing)
+dp.callback_query.middleware(handler_timing)
+
 ADMIN_IDS = {1291534395, 870424192}
 
+NOTIFICATION_BATCH_SIZE = 30
+NOTIFICATION_RETRY_DELAY = 60
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_BACKOFF_MIN = 1.0
+NOTIFICATION_BACKOFF_MAX = 60.0
 
-async def send_delayed_notification(recipient_id: int, sender_contact: str, delay: int):
-    await asyncio.sleep(delay)
-    try:
+PENDING_PAGE_SIZE = 20
+
+notifications_wakeup = asyncio.Event()
+notification_bucket = TokenBucket(GLOBAL_RATE)
+
+
+def build_recipients_keyboard(recipients) -> InlineKeyboardMarkup:
+    keyboard_buttons = []
+    for recipient_id, contact, status in recipients:
+        if status == 2:
+            continue
+        checked = "✓ " if status == 1 else ""
+        keyboard_buttons.append([
+            InlineKeyboardButton(
+                text=f"{checked}{contact}",
+                callback_data=f"toggle_{recipient_id}"
+            )
+        ])
+
+    if keyboard_buttons:
+        keyboard_buttons.append([
+            InlineKeyboardButton(text="Подтвердить", callback_data="confirm_letters")
+        ])
+
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+def build_recipients_text(recipients) -> str:
+    text = "Привет! Отметь людей, чьи письма ты кладёшь:\n"
+    for _, contact, status in recipients:
+        if status == 1:
+            text += f"{contact} (отправлено)\n"
+        elif status == 2:
+            text += f"{contact} (получено)\n"
+        else:
+            text += f"{contact}\n"
+    return text
+
+
+async def send_notification(recipient_id: int, letters: int = 1) -> Tuple[bool, Optional[float]]:
+    # Возвращает (отправлено, через сколько секунд повторить); None вместо
+    # задержки значит, что повторять бесполезно.
+    if letters > 1:
+        message_text = (
+            f"<b>Получено новых писем: {letters}</b>\n"
+            "Подойди на точку к Роме и Милане, чтобы забрать их!"
+        )
+    else:
         message_text = (
             "<b>Получено новое письмо</b>\n"
             "Подойди на точку к Роме и Милане, чтобы забрать его!"
         )
+    await notification_bucket.acquire()
+    try:
         await bot.send_message(chat_id=recipient_id, text=message_text, parse_mode="HTML")
-        logger.info(f"Уведомление отправлено получателю {recipient_id} через {delay} сек")
+        logger.info(f"Уведомление отправлено получателю {recipient_id} (писем: {letters})")
+        return True, None
+    except TelegramRetryAfter as e:
+        # Пауза действует и на остальные уведомления пачки, ждущие в bucket
+        logger.warning(
+            f"Flood control при отправке уведомления получателю {recipient_id}, "
+            f"пауза {e.retry_after} сек"
+        )
+        notification_bucket.pause(e.retry_after)
+        return False, e.retry_after
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.error(f"Уведомление получателю {recipient_id} не доставить: {e}")
+        return False, None
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления получателю {recipient_id}: {e}")
+        return False, NOTIFICATION_RETRY_DELAY
+
+
+async def process_due_notifications() -> int:
+    due = await get_due_notifications(time.time(), NOTIFICATION_BATCH_SIZE)
+    if not due:
+        return 0
+
+    results = await asyncio.gather(
+        *(send_notification(recipient_id, letters) for _, recipient_id, letters in due)
+    )
+    # Доставленные уведомления убираются из очереди, недоставляемые
+    # удаляются, остальные повторяются, пока не кончатся попытки.
+    now = time.time()
+    sent, dropped, postponed = [], [], []
+    for (notification_id, _, letters), (ok, retry_in) in zip(due, results):
+        if ok:
+            sent.append((notification_id, letters))
+        elif retry_in is None:
+            dropped.append(notification_id)
+        else:
+            postponed.append((notification_id, now + retry_in))
+    if sent:
+        await complete_notifications(sent, now + random.randint(30, 120))
+    if dropped:
+        await delete_notifications(dropped)
+    if postponed:
+        exhausted = await postpone_notifications(postponed, NOTIFICATION_MAX_ATTEMPTS)
+        if exhausted:
+            logger.error(
+                f"Уведомлений удалено после {NOTIFICATION_MAX_ATTEMPTS} неудачных попыток: {exhausted}"
+            )
+    return len(due)
+
+
+async def notification_scheduler():
+    # Очередь уведомлений хранится в базе, поэтому переживает перезапуск бота.
+    # Один цикл спит до ближайшего due_at или до нового подтверждения писем.
+    # На получателя в очереди одна строка со счётчиком писем, поэтому
+    # несколько подтверждений подряд дают одно сообщение.
+    backoff = NOTIFICATION_BACKOFF_MIN
+    while True:
+        try:
+            notifications_wakeup.clear()
+            processed = await process_due_notifications()
+            backoff = NOTIFICATION_BACKOFF_MIN
+            if processed:
+                if processed == NOTIFICATION_BATCH_SIZE:
+                    await asyncio.sleep(1)
+                continue
+
+            next_due = await get_next_notification_due()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Например, SQLITE_BUSY, пока distribute.py держит транзакцию:
+            # планировщик не должен умирать до конца мероприятия.
+            logger.exception(f"Ошибка в планировщике уведомлений, повтор через {backoff} сек")
+            await asyncio.sleep(backoff)
+            backoff = min(NOTIFICATION_BACKOFF_MAX, backoff * 2)
+            continue
+
+        timeout = None if next_due is None else max(0.0, next_due - time.time())
+        try:
+            await asyncio.wait_for(notifications_wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
 
 
 @dp.message(Command("take"))
@@ -69,12 +262,12 @@ async def take(message: Message):
         await message.answer("telegram_id должен быть числом")
         return
 
-    senders = take_letters_for_recipient(recipient_id)
+    senders = await take_letters_for_recipient(recipient_id)
     if not senders:
         await message.answer("Нет писем со статусом 1 для этого пользователя.")
         return
 
-    recipient_contact = get_user_contact(recipient_id)
+    recipient_contact = await get_user_contact(recipient_id)
     for sender_id in senders:
         try:
             await bot.send_message(sender_id, f"{recipient_contact} забрал твоё письмо!")
@@ -84,40 +277,153 @@ async def take(message: Message):
     await message.answer(f"Готово. Отмечено: {len(senders)}")
 
 
+def parse_pending_filter(value: str):
+    # Фильтр кодируется как "s<id>" (отправитель) или "r<id>" (получатель)
+    if value[:1] == "s":
+        return {"sender_id": int(value[1:])}
+    if value[:1] == "r":
+        return {"recipient_id": int(value[1:])}
+    return {}
+
+
+def build_pending_page(rows, has_prev: bool, has_next: bool, pending_filter: str):
+    text = "Письма со статусом 1:\n" + "".join(
+        f"{sid} ({format_contact(sf, sl, su)}) -> {rid} ({format_contact(rf, rl, ru)})\n"
+        for sid, su, sf, sl, rid, ru, rf, rl in rows
+    )
+
+    # Курсор — ключ первой или последней строки страницы; callback_data
+    # укладывается в лимит Telegram в 64 байта.
+    buttons = []
+    if has_prev:
+        sid, rid = rows[0][0], rows[0][4]
+        buttons.append(
+            InlineKeyboardButton(text="◀ Назад", callback_data=f"pending:p:{sid}:{rid}:{pending_filter}")
+        )
+    if has_next:
+        sid, rid = rows[-1][0], rows[-1][4]
+        buttons.append(
+            InlineKeyboardButton(text="Далее ▶", callback_data=f"pending:n:{sid}:{rid}:{pending_filter}")
+        )
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
+
+
 @dp.message(Command("pending"))
 async def pending(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
 
-    rows = get_pending_letters()
+    parts = message.text.split()
+    pending_filter = ""
+    if len(parts) > 1:
+        if len(parts) < 3 or parts[1] not in ("s", "r") or not parts[2].isdigit():
+            await message.answer("Использование: /pending [s <telegram_id> | r <telegram_id>]")
+            return
+        pending_filter = parts[1] + parts[2]
+
+    rows, has_next = await get_pending_letters_page(
+        limit=PENDING_PAGE_SIZE, **parse_pending_filter(pending_filter)
+    )
     if not rows:
         await message.answer("Нет писем со статусом 1.")
         return
 
-    def fmt_contact(username, first_name, last_name):
-        if username:
-            return f"@{username}" if not username.startswith("@") else username
-        return f"{first_name} {last_name or ''}".strip()
+    text, keyboard = build_pending_page(rows, False, has_next, pending_filter)
+    await message.answer(text, reply_markup=keyboard)
 
-    chunks = []
-    cur = ""
-    for i, (sid, su, sf, sl, rid, ru, rf, rl) in enumerate(rows, start=1):
-        line = f"{i}. {sid} ({fmt_contact(su, sf, sl)}) -> {rid} ({fmt_contact(ru, rf, rl)})\n"
-        if len(cur) + len(line) > 3900:
-            chunks.append(cur)
-            cur = ""
-        cur += line
-    if cur:
-        chunks.append(cur)
 
-    for text in chunks:
-        await message.answer(text)
+@dp.callback_query(F.data.startswith("pending:"))
+async def pending_page(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+
+    _, direction, sid, rid, pending_filter = callback.data.split(":")
+    backward = direction == "p"
+    rows, has_more = await get_pending_letters_page(
+        cursor=(int(sid), int(rid)),
+        backward=backward,
+        limit=PENDING_PAGE_SIZE,
+        **parse_pending_filter(pending_filter),
+    )
+    await callback.answer()
+    if not rows:
+        await callback.message.edit_text("Нет писем со статусом 1.")
+        return
+
+    # Страница, с которой пришли, существует, поэтому в обратную сторону
+    # кнопка нужна всегда.
+    has_prev, has_next = (has_more, True) if backward else (True, has_more)
+    text, keyboard = build_pending_page(rows, has_prev, has_next, pending_filter)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+@dp.message(Command("stats"))
+async def stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    counters = await get_stats()
+    letters = [counters.get(f"distribution.status.{status}", 0) for status in (0, 1, 2)]
+    confirmed = counters.get("users.confirmed.1", 0)
+    cache = contact_cache_stats()
+    unconfirmed = counters.get("users.confirmed.0", 0)
+
+    await message.answer(
+        f"Пользователей: {confirmed + unconfirmed} "
+        f"(подтвердили {confirmed}, не подтвердили {unconfirmed})\n"
+        f"Писем всего: {sum(letters)}\n"
+        f"  не положены: {letters[0]}\n"
+        f"  ждут получателя: {letters[1]}\n"
+        f"  получены: {letters[2]}\n"
+        f"Кэш контактов: {cache['size']}/{cache['maxsize']}, "
+        f"попаданий {cache['hits']}, промахов {cache['misses']}"
+    )
+
+
+@dp.message(Command("metrics"))
+async def metrics_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    await message.answer(metrics.summary())
+
+
+@dp.message(Command("profile"))
+async def profile_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == "stop":
+        if not profiling.stop_profiling():
+            await message.answer("Профилирование не запущено.")
+        return
+
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 30
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await message.answer(
+            f"Использование: /profile [секунд, до {PROFILE_MAX_SECONDS}] или /profile stop"
+        )
+        return
+    if profiling.is_profiling():
+        await message.answer("Профилирование уже запущено.")
+        return
+
+    await message.answer(f"Профилирую {seconds} сек. Остановить раньше: /profile stop")
+    report = await profiling.profile(seconds)
+    await message.answer_document(
+        BufferedInputFile(report.encode(), filename=f"profile-{int(time.time())}.txt")
+    )
 
 
 @dp.message(Command("start"))
 async def start(message: Message):
     user = message.from_user
-    add_user(
+    await add_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -128,52 +434,21 @@ async def start(message: Message):
     start_param = args[0] if args else None
 
     if start_param == "resetcorporate":
-        recipients = get_recipients_for_sender(user.id)
-        if not recipients:
+        if not await set_sender_status(user.id, 0):
             await message.answer("У тебя нет подопечных для сброса.")
             return
 
-        for recipient_id, _, _, _, _ in recipients:
-            update_distribution_status(user.id, recipient_id, 0)
-
         await message.answer("Готово: всем подопечным выставлен статус 0.")
         return
 
     if start_param == "corporate26":
-        recipients = get_recipients_for_sender(user.id)
+        recipients = await get_recipient_contacts(user.id)
         if not recipients:
             await message.answer("У тебя нет получателей для отметки.")
             return
 
-        keyboard_buttons = []
-        for recipient_id, first_name, last_name, username, status in recipients:
-            if status == 2:
-                continue
-            contact = get_user_contact(recipient_id)
-            checked = "✓ " if status == 1 else ""
-            keyboard_buttons.append([
-                InlineKeyboardButton(
-                    text=f"{checked}{contact}",
-                    callback_data=f"toggle_{recipient_id}"
-                )
-            ])
-
-        if keyboard_buttons:
-            keyboard_buttons.append([
-                InlineKeyboardButton(text="Подтвердить", callback_data="confirm_letters")
-            ])
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-
-        text = "Привет! Отметь людей, чьи письма ты кладёшь:\n"
-        for recipient_id, _, _, _, status in recipients:
-            contact = get_user_contact(recipient_id)
-            if status == 1:
-                text += f"{contact} (отправлено)\n"
-            elif status == 2:
-                text += f"{contact} (получено)\n"
-            else:
-                text += f"{contact}\n"
+        keyboard = build_recipients_keyboard(recipients)
+        text = build_recipients_text(recipients)
 
         await message.answer(text, reply_markup=keyboard)
         return
@@ -202,8 +477,8 @@ async def start(message: Message):
 async def button_callback(callback: CallbackQuery):
     await callback.answer()
 
-    if not is_confirmed(callback.from_user.id):
-        confirm_user(callback.from_user.id)
+    if not await is_confirmed(callback.from_user.id):
+        await confirm_user(callback.from_user.id)
         await callback.message.edit_reply_markup(reply_markup=None)
         await callback.message.answer("Супер, ты зарегистрирован! Жди сообщений!")
     else:
@@ -216,37 +491,12 @@ async def toggle_recipient(callback: CallbackQuery):
     recipient_id = int(callback.data.split("_")[1])
     sender_id = callback.from_user.id
 
-    recipients = get_recipients_for_sender(sender_id)
-    recipient_data = next((r for r in recipients if r[0] == recipient_id), None)
-    
-    if not recipient_data:
+    new_status, recipients = await toggle_distribution_status(sender_id, recipient_id)
+    if new_status is None:
         await callback.answer("Получатель не найден", show_alert=True)
         return
 
-    current_status = recipient_data[4]
-    new_status = 1 if current_status == 0 else 0
-    update_distribution_status(sender_id, recipient_id, new_status)
-
-    keyboard_buttons = []
-    recipients = get_recipients_for_sender(sender_id)
-    for rec_id, first_name, last_name, username, status in recipients:
-        if status == 2:
-            continue
-        contact = get_user_contact(rec_id)
-        checked = "✓ " if status == 1 else ""
-        keyboard_buttons.append([
-            InlineKeyboardButton(
-                text=f"{checked}{contact}",
-                callback_data=f"toggle_{rec_id}"
-            )
-        ])
-
-    if keyboard_buttons:
-        keyboard_buttons.append([
-            InlineKeyboardButton(text="Подтвердить", callback_data="confirm_letters")
-        ])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    keyboard = build_recipients_keyboard(recipients)
     await callback.message.edit_reply_markup(reply_markup=keyboard)
     await callback.answer()
 
@@ -257,19 +507,19 @@ async def confirm_letters(callback: CallbackQuery):
     await callback.message.edit_reply_markup(reply_markup=None)
     
     sender_id = callback.from_user.id
-    sender_contact = get_user_contact(sender_id)
-    
-    recipients = get_recipients_for_sender(sender_id)
+
+    recipients = await get_recipients_for_sender(sender_id)
     marked_recipients = [r for r in recipients if r[4] == 1]
     
-    if marked_recipients:
-        for recipient_id, _, _, _, _ in marked_recipients:
-            delay = random.randint(30, 120)
-            asyncio.create_task(send_delayed_notification(recipient_id, sender_contact, delay))
-            update_distribution_status(sender_id, recipient_id, 1)
-        
+    now = time.time()
+    scheduled = await schedule_notifications(
+        sender_id, [(r[0], now + random.randint(30, 120)) for r in marked_recipients]
+    )
+    
+    if scheduled:
+        notifications_wakeup.set()
         await callback.message.answer(
-            f"Спасибо за участие! Уведомления будут отправлены {len(marked_recipients)} получателям в течение 2 минут."
+            f"Спасибо за участие! Уведомления будут отправлены {scheduled} получателям в течение 2 минут."
         )
     else:
         await callback.message.answer(
@@ -277,11 +527,79 @@ async def confirm_letters(callback: CallbackQuery):
         )
 
 
-async def main():
-    init_db()
+_scheduler: asyncio.Task | None = None
+_lag_monitor: asyncio.Task | None = None
+_metrics_runner: web.AppRunner | None = None
+
+
+async def start_metrics_server(port: int):
+    global _metrics_runner
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics.handle_metrics)
+    _metrics_runner = web.AppRunner(app, access_log=None)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики доступны на {METRICS_HOST}:{port}{METRICS_PATH}")
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    global _scheduler, _lag_monitor
+    await init_db()
+    _scheduler = asyncio.create_task(notification_scheduler())
+    if LOOP_LAG_MS:
+        _lag_monitor = asyncio.create_task(profiling.monitor_loop_lag(LOOP_LAG_MS))
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+    if BOT_MODE == "webhook" and WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET
+        )
+        logger.info(f"Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    elif BOT_MODE != "webhook":
+        # Пока вебхук от прошлого запуска зарегистрирован, getUpdates
+        # отвечает 409 Conflict. Накопившиеся апдейты не сбрасываем.
+        await bot.delete_webhook()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    global _metrics_runner
+    # Новые апдейты уже не принимаются; даём доработать начатым и только
+    # потом останавливаем планировщик и закрываем базу. Идущее профилирование
+    # завершаем сразу, чтобы его хендлер не держал остановку.
+    profiling.stop_profiling()
+    await concurrency_limit.drain(SHUTDOWN_TIMEOUT)
+    if _scheduler is not None:
+        _scheduler.cancel()
+    if _lag_monitor is not None:
+        _lag_monitor.cancel()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+    shutdown_db()
+
+
+def build_webhook_app(path: str = WEBHOOK_PATH, secret: str | None = WEBHOOK_SECRET) -> web.Application:
+    if not secret:
+        raise RuntimeError("Режим webhook требует WEBHOOK_SECRET или WEBHOOK_URL для его генерации")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
 
+async def main():
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        web.run_app(
+            build_webhook_app(),
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            shutdown_timeout=SHUTDOWN_TIMEOUT,
+        )
+    else:
+        asyncio.run(main())
@@ -0,0 +1,123 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence
+
+from aiohttp import web
+
+import sql
+
+# Границы корзин в секундах: от быстрых ответов из кэша до медленных
+# хендлеров, упёршихся в очередь к базе или flood control.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Счётчики по корзинам (последняя — +Inf), сумма и количество
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                label_value: (list(counts), total, count)
+                for label_value, (counts, total, count) in self._series.items()
+            }
+
+    def quantile(self, label_value: str, q: float) -> float:
+        # Верхняя граница корзины, в которую попадает квантиль
+        counts, _, count = self.snapshot().get(label_value, ([], 0.0, 0))
+        if not count:
+            return 0.0
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket
+            if cumulative >= q * count:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self.snapshot().items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта хендлером", "handler"
+)
+
+
+def _counter(name: str, documentation: str, label: str, values: Dict[str, float]) -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+    lines.extend(f'{name}{{{label}="{key}"}} {value}' for key, value in sorted(values.items()))
+    return lines
+
+
+def render() -> str:
+    # Текстовый формат экспозиции Prometheus 0.0.4
+    functions = sql.function_stats()
+    cache = sql.contact_cache_stats()
+    lines = HANDLER_LATENCY.render()
+    lines += _counter(
+        "sql_function_calls_total", "Вызовы функций sql.py", "function",
+        {name: stats[0] for name, stats in functions.items()},
+    )
+    lines += _counter(
+        "sql_function_queries_total", "Выполненные SQL-запросы по функциям sql.py", "function",
+        {name: stats[1] for name, stats in functions.items()},
+    )
+    lines += _counter(
+        "sql_function_seconds_total", "Время в функциях sql.py", "function",
+        {name: stats[2] for name, stats in functions.items()},
+    )
+    lines += _counter(
+        "contact_cache_requests_total", "Обращения к кэшу контактов", "result",
+        {"hit": cache["hits"], "miss": cache["misses"]},
+    )
+    return "\n".join(lines) + "\n"
+
+
+def summary(top: int = 10) -> str:
+    # Короткая сводка для админа в чате: самые нагруженные хендлеры и функции
+    lines = ["Хендлеры (вызовов, среднее, p95 ≤):"]
+    handlers = HANDLER_LATENCY.snapshot()
+    for name, (_, total, count) in sorted(handlers.items(), key=lambda item: -item[1][1]):
+        p95 = HANDLER_LATENCY.quantile(name, 0.95)
+        lines.append(f"  {name}: {count}, {total / count * 1000:.1f} мс, {p95 * 1000:g} мс")
+    if not handlers:
+        lines.append("  нет данных")
+
+    lines.append(f"База, топ-{top} по времени (вызовов, запросов, всего):")
+    functions = sorted(sql.function_stats().items(), key=lambda item: -item[1][2])[:top]
+    for name, (calls, queries, seconds) in functions:
+        lines.append(f"  {name}: {calls}, {queries}, {seconds * 1000:.0f} мс")
+    if not functions:
+        lines.append("  нет данных")
+    return "\n".join(lines)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
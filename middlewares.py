@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    # Ограничивает число одновременно обрабатываемых апдейтов. В режиме
+    # webhook aiogram запускает задачу на каждый запрос без ограничений,
+    # поэтому лишние ждут здесь, а не толкаются в очередь к базе.
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self._active += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._active -= 1
+            if not self._active:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        # Дожидается апдейтов, которые уже приняты в обработку
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except TimeoutError:
+            logger.warning(f"Не дождались завершения {self._active} апдейтов за {timeout} сек")
+            return False
+        return True
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается, только когда нашёлся хендлер,
+    # поэтому время пишется в гистограмму под его именем.
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.histogram.observe(
+                data["handler"].callback.__name__, time.perf_counter() - start
+            )
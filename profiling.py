@@ -0,0 +1,147 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from typing import Optional
+
+import async_sql
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOP = 60
+SAMPLE_INTERVAL = 0.005
+
+_stop: Optional[asyncio.Event] = None
+
+
+async def monitor_loop_lag(threshold_ms: float, interval: float = 0.5):
+    # Если цикл событий чем-то заблокирован, sleep просыпается позже
+    # положенного; опоздание и есть задержка всех апдейтов в этот момент.
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - start - interval
+        if lag * 1000 >= threshold_ms:
+            logger.warning(f"Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+
+
+def _label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+def _is_idle_worker(code) -> bool:
+    # Поток исполнителя без задачи стоит в _worker на чтении очереди
+    return code.co_name == "_worker" and code.co_filename.endswith(
+        os.path.join("concurrent", "futures", "thread.py")
+    )
+
+
+def _stack(frame):
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+
+
+class ThreadSampler:
+    # Сэмплирующий профилировщик одного потока: раз в interval снимает его
+    # стек через sys._current_frames. Включать его в самом потоке не нужно,
+    # и он не конфликтует с cProfile, который может быть активен только один.
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.idle = 0
+        self.own: Counter = Counter()
+        self.total: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            if _is_idle_worker(frame.f_code):
+                self.idle += 1
+                continue
+            self.own[_label(frame.f_code)] += 1
+            # Рекурсивная функция в одном стеке считается один раз
+            self.total.update({_label(f.f_code) for f in _stack(frame)})
+
+    def report(self, top: int) -> str:
+        busy = self.samples - self.idle
+        lines = [
+            f"Сэмплов: {self.samples} раз в {self.interval * 1000:g} мс, "
+            f"поток занят в {busy / max(1, self.samples):.0%} из них"
+        ]
+        for title, counter in (("Собственное время", self.own), ("Включая вложенные вызовы", self.total)):
+            lines.append(f"\n{title} (сэмплов, доля от занятого):")
+            for label, count in counter.most_common(top):
+                lines.append(f"  {count:>7}  {count / max(1, busy):>6.1%}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+def is_profiling() -> bool:
+    return _stop is not None
+
+
+def stop_profiling() -> bool:
+    if _stop is None:
+        return False
+    _stop.set()
+    return True
+
+
+async def profile(seconds: float, top: int = PROFILE_TOP, executor: Optional[Executor] = None) -> str:
+    # cProfile видит только поток цикла событий: работа, отправленная в уже
+    # запущенный поток исполнителя async_sql, в его отчёт не попадает, а
+    # второй cProfile там не включить, пока активен первый. Поэтому поток
+    # базы, где выполняются запросы, снимается сэмплированием. Одновременно
+    # может работать только одно профилирование.
+    global _stop
+    if _stop is not None:
+        raise RuntimeError("Профилирование уже запущено")
+    _stop = asyncio.Event()
+    try:
+        executor = executor if executor is not None else async_sql._executor
+        db_thread = await asyncio.get_running_loop().run_in_executor(executor, threading.get_ident)
+        sampler = ThreadSampler(db_thread)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        sampler.start()
+        profiler.enable()
+        try:
+            await asyncio.wait_for(_stop.wait(), seconds)
+        except TimeoutError:
+            pass
+        finally:
+            profiler.disable()
+            sampler.stop()
+    finally:
+        _stop = None
+    elapsed = time.perf_counter() - start
+
+    stream = io.StringIO()
+    stream.write(f"Профиль за {elapsed:.1f} с\n\n== Цикл событий (cProfile) ==\n")
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(top)
+    stats.sort_stats("tottime").print_stats(top)
+    stream.write("\n== Поток базы (сэмплирование) ==\n")
+    stream.write(sampler.report(top))
+    return stream.getvalue()
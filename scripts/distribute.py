@@ -1,108 +1,749 @@
-import random
+import argparse
+import csv
+import hashlib
+import json
+import secrets
 import sqlite3
+import sys
 from collections import defaultdict
-from typing import Dict, List, Tuple
-
-DB_NAME = "users.db"
-
-
-def recreate_distribution_table():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DROP TABLE IF EXISTS distribution")
-    cursor.execute("""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sql import (  # noqa: E402
+    connection,
+    create_distribution_indexes,
+    create_distribution_triggers,
+    get_last_draw,
+    init_db,
+    insert_draw,
+    rebuild_distribution_stats,
+    transaction,
+)
+
+
+def recreate_distribution_table(conn: sqlite3.Connection):
+    conn.execute("DROP TABLE IF EXISTS distribution")
+    conn.execute("""
         CREATE TABLE distribution (
             telegram_id_sender INTEGER NOT NULL,
             telegram_id_recipient INTEGER NOT NULL,
             status INTEGER DEFAULT 0,
+            notified INTEGER NOT NULL DEFAULT 0,
             PRIMARY KEY (telegram_id_sender, telegram_id_recipient)
         )
     """)
-    conn.commit()
-    conn.close()
+
+
+def _save_pairs(pairs: Iterable[Tuple[int, int]], draw: Optional[Tuple] = None):
+    # Таблица пересоздаётся и заполняется в одной транзакции, а вторичные
+    # индексы и триггеры счётчиков создаются уже после загрузки: так быстрее,
+    # чем обновлять их на каждую вставку. Счётчики пересчитываются одним GROUP BY.
+    # Запись о жеребьёвке (аргументы insert_draw) коммитится вместе с парами,
+    # чтобы в draws не остался seed несохранённого распределения.
+    with transaction() as conn:
+        if draw is not None:
+            insert_draw(conn, *draw)
+        recreate_distribution_table(conn)
+        conn.executemany(
+            """
+            INSERT INTO distribution (telegram_id_sender, telegram_id_recipient, status)
+            VALUES (?, ?, 0)
+        """,
+            pairs,
+        )
+        create_distribution_indexes(conn)
+        create_distribution_triggers(conn)
+        rebuild_distribution_stats(conn)
 
 
 def save_distribution(distribution: Dict[int, List[int]]):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    for sender_id, receivers in distribution.items():
-        for receiver_id in receivers:
-            cursor.execute("""
-                INSERT INTO distribution (telegram_id_sender, telegram_id_recipient, status)
-                VALUES (?, ?, 0)
-            """, (sender_id, receiver_id))
-    conn.commit()
-    conn.close()
+    _save_pairs(
+        (sender_id, receiver_id)
+        for sender_id, receivers in distribution.items()
+        for receiver_id in receivers
+    )
 
 
-def get_all_confirmed_users() -> List[Tuple[int, str, str]]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id, first_name, last_name FROM users WHERE confirmed = 1"
+def save_distribution_array(
+    senders: np.ndarray, receivers: np.ndarray, draw: Optional[Tuple] = None
+):
+    _save_pairs(
+        zip(
+            np.repeat(senders, receivers.shape[1]).tolist(),
+            receivers.ravel().tolist(),
+        ),
+        draw,
     )
-    users = cursor.fetchall()
-    conn.close()
-    return users
+
+
+def get_registration_cohorts() -> Dict[int, str]:
+    with connection() as conn:
+        return dict(
+            conn.execute(
+                "SELECT user_id, date(registered_at) FROM users WHERE confirmed = 1"
+            ).fetchall()
+        )
+
+
+def get_all_confirmed_users() -> List[Tuple[int, str, str]]:
+    with connection() as conn:
+        return conn.execute(
+            "SELECT user_id, first_name, last_name FROM users WHERE confirmed = 1"
+        ).fetchall()
+
+
+def resolve_k(n: int, k: Optional[int] = None) -> int:
+    if k is None:
+        k = max(1, n // 2)
+    return min(k, n - 1)
+
+
+def create_distribution_array(
+    user_ids, k: int, rng: Optional[np.random.Generator] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Отправители — перемешанное кольцо участников, i-й пишет следующим k
+    # по кольцу. Строка receivers[i] — получатели senders[i].
+    rng = rng if rng is not None else np.random.default_rng()
+    senders = rng.permutation(np.sort(np.fromiter(user_ids, dtype=np.int64)))
+    n = len(senders)
+    offsets = np.add.outer(np.arange(n), np.arange(1, k + 1)) % n
+    return senders, senders[offsets]
 
 
 def create_distribution(
     users: List[Tuple[int, str, str]], k: int = None
 ) -> Dict[int, List[int]]:
-    if not users:
+    if len(users) < 2:
         return {}
 
+    k = resolve_k(len(users), k)
+    senders, receivers = create_distribution_array([user[0] for user in users], k)
+    return dict(zip(senders.tolist(), receivers.tolist()))
+
+
+class DistributionInfeasibleError(ValueError):
+    pass
+
+
+REPAIR_TRIES = 200
+REPAIR_RESTARTS = 5
+# Сколько кандидатов на обмен можно проверить на одно ребро графа за всю
+# починку; ограничивает время, когда ограничения невыполнимы.
+REPAIR_BUDGET = 20
+
+
+def _team_codes(nodes: np.ndarray, teams: Optional[Dict[int, str]]) -> np.ndarray:
+    codes = np.full(len(nodes), -1, dtype=np.int64)
+    if teams:
+        names = {}
+        for i, user_id in enumerate(nodes.tolist()):
+            team = teams.get(user_id)
+            if team is not None:
+                codes[i] = names.setdefault(team, len(names))
+    return codes
+
+
+def _pair_keys(nodes: np.ndarray, pairs) -> np.ndarray:
+    pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+    idx = np.searchsorted(nodes, pairs)
+    idx = np.minimum(idx, len(nodes) - 1)
+    known = (nodes[idx] == pairs).all(axis=1)
+    return np.unique(idx[known, 0] * len(nodes) + idx[known, 1])
+
+
+def _contains(sorted_keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+    if not len(sorted_keys):
+        return np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+    return sorted_keys[pos] == values
+
+
+def _check_feasibility(
+    n: int, k: int, codes: np.ndarray, banned: np.ndarray, allow_reciprocal: bool
+):
+    if k > n - 1:
+        raise DistributionInfeasibleError(f"k={k} больше, чем n-1={n - 1}")
+    if not allow_reciprocal and 2 * k > n - 1:
+        raise DistributionInfeasibleError(
+            f"Без взаимных пар k должно быть не больше (n-1)/2, а k={k}, n={n}"
+        )
+
+    # Письма участникам команды могут прийти только от остальных n - t
+    # человек, и каждый из них отправляет столько же, сколько получает.
+    team_sizes = np.bincount(codes[codes >= 0], minlength=1)
+    largest = int(team_sizes.max())
+    if 2 * largest > n:
+        raise DistributionInfeasibleError(
+            f"Команда из {largest} человек больше половины участников (n={n}): "
+            "вне команды не хватит отправителей"
+        )
+    teammates = np.where(codes >= 0, team_sizes[np.maximum(codes, 0)] - 1, 0)
+    src, dst = banned // n, banned % n
+    extra = (src != dst) & ((codes[src] < 0) | (codes[src] != codes[dst]))
+    allowed_out = n - 1 - teammates - np.bincount(src[extra], minlength=n)
+    allowed_in = n - 1 - teammates - np.bincount(dst[extra], minlength=n)
+    # Это только необходимое условие; если его хватает, но граф всё равно
+    # не собирается, об этом сообщит починка.
+    short = (allowed_out < k) | (allowed_in < k)
+    if not allow_reciprocal:
+        # Адресаты и отправители участника без взаимных пар не пересекаются
+        short |= n - 1 - teammates < 2 * k
+    short = np.flatnonzero(short)
+    if len(short):
+        raise DistributionInfeasibleError(
+            f"У {len(short)} участник(ов) меньше k={k} допустимых адресатов или отправителей"
+        )
+
+
+def _spread_teams(nodes: np.ndarray, codes: np.ndarray, rng: np.random.Generator):
+    # Участников одной команды раскладываем по кольцу равномерно: i-й член
+    # команды размера t встаёт примерно на позицию i/t, так что соседей по
+    # кольцу из одной команды почти нет и чинить приходится мало рёбер.
+    order = rng.permutation(len(nodes))
+    order = order[np.argsort(codes[order], kind="stable")]
+    grouped = codes[order]
+    first = np.searchsorted(grouped, grouped, side="left")
+    size = np.searchsorted(grouped, grouped, side="right") - first
+    shift = rng.random(int(grouped.max()) + 2)[grouped + 1]
+    rank = (np.arange(len(order)) - first + shift) / size
+    rank = np.where(grouped >= 0, rank, rng.random(len(order)))
+    return nodes[order[np.argsort(rank, kind="stable")]]
+
+
+SHIFT_CANDIDATES = 64
+
+
+def _edge_violations(
+    sources: np.ndarray, targets: np.ndarray, codes: np.ndarray, banned: np.ndarray
+) -> np.ndarray:
+    n = len(codes)
+    bad = _contains(banned, sources * n + targets)
+    bad |= (codes[sources] >= 0) & (codes[sources] == codes[targets])
+    return bad
+
+
+def _choose_shifts(
+    sender_idx: np.ndarray,
+    k: int,
+    codes: np.ndarray,
+    banned: np.ndarray,
+    allow_reciprocal: bool,
+) -> np.ndarray:
+    # Кольцо с любым набором различных сдвигов даёт ровно k входящих и
+    # исходящих. Из первых сдвигов выбираем те, что нарушают меньше всего
+    # ограничений; сдвиги s и n-s вместе дают взаимные пары.
+    n = len(sender_idx)
+    candidates = np.arange(1, min(n - 1, max(SHIFT_CANDIDATES, 4 * k)) + 1)
+    cost = [
+        int(_edge_violations(sender_idx, np.roll(sender_idx, -shift), codes, banned).sum())
+        for shift in candidates.tolist()
+    ]
+    chosen = []
+    for shift in candidates[np.argsort(cost, kind="stable")].tolist():
+        if not allow_reciprocal and (n - shift in chosen or 2 * shift == n):
+            continue
+        chosen.append(shift)
+        if len(chosen) == k:
+            break
+    if len(chosen) < k:
+        chosen = list(range(1, k + 1))
+    return np.asarray(chosen)
+
+
+def _repair(
+    sender_idx: np.ndarray,
+    receiver_idx: np.ndarray,
+    codes: np.ndarray,
+    banned: np.ndarray,
+    allow_reciprocal: bool,
+    rng: np.random.Generator,
+) -> Optional[List[List[int]]]:
+    n, k = receiver_idx.shape
+    bad = _edge_violations(
+        np.repeat(sender_idx, k), receiver_idx.ravel(), codes, banned
+    )
+
+    # Плохое ребро a->b меняем местами с ребром c->d на a->d и c->b:
+    # степени всех вершин при этом не меняются. Сначала пробуем случайные
+    # рёбра, и только если не повезло — перебираем все.
+    banned_set = set(banned.tolist())
+    codes = codes.tolist()
+    rows = receiver_idx.tolist()
+    row_of = np.empty(n, dtype=np.int64)
+    row_of[sender_idx] = np.arange(n)
+    row_of = row_of.tolist()
+    sender_list = sender_idx.tolist()
+
+    def is_banned(a: int, b: int) -> bool:
+        return (codes[a] >= 0 and codes[a] == codes[b]) or a * n + b in banned_set
+
+    def has_edge(a: int, b: int) -> bool:
+        return b in rows[row_of[a]]
+
+    budget = REPAIR_BUDGET * n * k
+
+    def candidates():
+        yield from rng.integers(n * k, size=REPAIR_TRIES).tolist()
+        start = int(rng.integers(n * k))
+        yield from range(start, n * k)
+        yield from range(start)
+
+    def fix(i: int, p: int) -> bool:
+        nonlocal budget
+        a, b = sender_list[i], rows[i][p]
+        for other in candidates():
+            budget -= 1
+            if budget < 0:
+                return False
+            j, q = divmod(other, k)
+            c, d = sender_list[j], rows[j][q]
+            if j == i or a == d or c == b:
+                continue
+            if is_banned(a, d) or is_banned(c, b) or has_edge(a, d) or has_edge(c, b):
+                continue
+            if not allow_reciprocal and (has_edge(d, a) or has_edge(b, c)):
+                continue
+            rows[i][p], rows[j][q] = d, b
+            return True
+        return False
+
+    # Ребро, которое не чинится сейчас, может починиться после соседних
+    # замен, поэтому проходим по оставшимся, пока есть прогресс.
+    pending = [divmod(edge, k) for edge in np.flatnonzero(bad).tolist()]
+    while pending:
+        stuck = [
+            (i, p)
+            for i, p in pending
+            if is_banned(sender_list[i], rows[i][p]) and not fix(i, p)
+        ]
+        if len(stuck) == len(pending) or budget < 0:
+            return None
+        pending = stuck
+    return rows
+
+
+def create_constrained_distribution_array(
+    user_ids,
+    k: int,
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+    allow_reciprocal: bool = True,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    rng = rng if rng is not None else np.random.default_rng()
+    nodes = np.sort(np.fromiter(user_ids, dtype=np.int64))
+    n = len(nodes)
+    codes = _team_codes(nodes, teams)
+    banned = _pair_keys(nodes, exclusions)
+    _check_feasibility(n, k, codes, banned, allow_reciprocal)
+
+    for _ in range(REPAIR_RESTARTS):
+        senders = _spread_teams(nodes, codes, rng)
+        sender_idx = np.searchsorted(nodes, senders)
+        shifts = _choose_shifts(sender_idx, k, codes, banned, allow_reciprocal)
+        offsets = np.add.outer(np.arange(n), shifts) % n
+        rows = _repair(sender_idx, sender_idx[offsets], codes, banned, allow_reciprocal, rng)
+        if rows is not None:
+            return senders, nodes[np.asarray(rows, dtype=np.int64)]
+
+    raise DistributionInfeasibleError(
+        f"Не удалось построить распределение с k={k} за {REPAIR_RESTARTS} попыток: "
+        "ограничения слишком жёсткие"
+    )
+
+
+def create_constrained_distribution(
+    users: List[Tuple[int, str, str]],
+    k: int = None,
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+    allow_reciprocal: bool = True,
+) -> Dict[int, List[int]]:
     if len(users) < 2:
         return {}
 
-    user_ids = [user[0] for user in users]
-    n = len(user_ids)
+    k = resolve_k(len(users), k)
+    senders, receivers = create_constrained_distribution_array(
+        [user[0] for user in users], k, exclusions, teams, allow_reciprocal
+    )
+    return dict(zip(senders.tolist(), receivers.tolist()))
 
-    if k is None:
-        k = max(1, n // 2)
 
-    k = min(k, n - 1)
+def verify_edges(
+    senders: np.ndarray, sources: np.ndarray, targets: np.ndarray
+) -> Tuple[bool, Dict[str, int]]:
+    nodes = np.unique(np.concatenate([senders, targets]))
+    source_idx = np.searchsorted(nodes, sources)
+    target_idx = np.searchsorted(nodes, targets)
+    outgoing = np.bincount(source_idx, minlength=len(nodes))
+    incoming = np.bincount(target_idx, minlength=len(nodes))
 
-    random.shuffle(user_ids)
+    edges = np.sort(source_idx * len(nodes) + target_idx)
+    duplicates = int(np.count_nonzero(edges[1:] == edges[:-1]))
+    self_loops = int(np.count_nonzero(sources == targets))
 
-    distribution = defaultdict(list)
+    regular = outgoing.min() == outgoing.max() and incoming.min() == incoming.max()
+    stats = {
+        "outgoing_count": int(outgoing.max()),
+        "incoming_count": int(incoming.max()),
+        "total_users": len(senders),
+        "self_loops": self_loops,
+        "duplicates": duplicates,
+    }
+    return bool(regular) and not self_loops and not duplicates, stats
+
+
+def build_distribution(
+    user_ids, k: int, seed: int, constraints: Optional[Dict] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Результат полностью определяется набором участников, k, ограничениями
+    # и seed; всё это записывается в draws, чтобы жеребьёвку можно было повторить.
+    rng = np.random.default_rng(seed)
+    if constraints:
+        return create_constrained_distribution_array(user_ids, k, rng=rng, **constraints)
+    return create_distribution_array(user_ids, k, rng)
+
+
+def encode_constraints(constraints: Optional[Dict]) -> str:
+    # Каноничная запись: одинаковые ограничения дают одинаковую строку
+    constraints = constraints or {}
+    return json.dumps(
+        {
+            "exclusions": sorted(map(list, set(constraints.get("exclusions") or ()))),
+            "teams": {str(user_id): team for user_id, team in (constraints.get("teams") or {}).items()},
+            "allow_reciprocal": constraints.get("allow_reciprocal", True),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
 
-    for i, sender_id in enumerate(user_ids):
-        for j in range(1, k + 1):
-            receiver_idx = (i + j) % n
-            receiver_id = user_ids[receiver_idx]
-            distribution[sender_id].append(receiver_id)
 
-    return dict(distribution)
+def decode_constraints(encoded: str) -> Optional[Dict]:
+    data = json.loads(encoded)
+    if not data["exclusions"] and not data["teams"] and data["allow_reciprocal"]:
+        return None
+    return {
+        "exclusions": [tuple(pair) for pair in data["exclusions"]],
+        "teams": {int(user_id): team for user_id, team in data["teams"].items()},
+        "allow_reciprocal": data["allow_reciprocal"],
+    }
 
 
-def verify_distribution(
-    distribution: Dict[int, List[int]],
+def check_recorded_constraints(
+    constraints: Optional[Dict], recorded: str, allow_additions: bool = False
+) -> Optional[Dict]:
+    # Без флагов берутся ограничения записанной жеребьёвки. Явные флаги должны
+    # с ними совпадать; при достройке они могут только добавлять новое,
+    # например команды опоздавших.
+    if constraints is None:
+        return decode_constraints(recorded)
+    current, previous = json.loads(encode_constraints(constraints)), json.loads(recorded)
+    if allow_additions:
+        compatible = (
+            current["allow_reciprocal"] == previous["allow_reciprocal"]
+            and set(map(tuple, previous["exclusions"])) <= set(map(tuple, current["exclusions"]))
+            and previous["teams"].items() <= current["teams"].items()
+        )
+    else:
+        compatible = current == previous
+    if not compatible:
+        raise ValueError("Ограничения отличаются от записанных в жеребьёвке")
+    return constraints
+
+
+def participants_digest(user_ids) -> str:
+    return hashlib.sha256(",".join(map(str, sorted(user_ids))).encode()).hexdigest()
+
+
+def score_reciprocal_pairs(senders: np.ndarray, receivers: np.ndarray) -> float:
+    return float(
+        count_violations(np.repeat(senders, receivers.shape[1]), receivers.ravel())[
+            "reciprocal"
+        ]
+    )
+
+
+class SameGroupScore:
+    # Сколько писем уходит внутри одной группы (команда, когорта регистрации).
+    # Меньше — лучше: участники знакомятся с людьми из других групп.
+    def __init__(self, groups: Dict[int, object]):
+        ids = np.fromiter(groups.keys(), dtype=np.int64, count=len(groups))
+        order = np.argsort(ids)
+        self.ids = ids[order]
+        self.codes = _team_codes(self.ids, groups)
+
+    def _codes(self, user_ids: np.ndarray) -> np.ndarray:
+        if not len(self.ids):
+            return np.full(user_ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.ids, user_ids), len(self.ids) - 1)
+        return np.where(self.ids[pos] == user_ids, self.codes[pos], -1)
+
+    def __call__(self, senders: np.ndarray, receivers: np.ndarray) -> float:
+        sender_codes = self._codes(senders)[:, None]
+        return float(
+            np.count_nonzero((sender_codes >= 0) & (sender_codes == self._codes(receivers)))
+        )
+
+
+_search_state = None
+
+
+def _init_search(user_ids, k, score, constraints):
+    global _search_state
+    _search_state = (user_ids, k, score, constraints)
+
+
+def _evaluate_seed(seed: int) -> Tuple[float, int]:
+    user_ids, k, score, constraints = _search_state
+    try:
+        senders, receivers = build_distribution(user_ids, k, seed, constraints)
+    except DistributionInfeasibleError:
+        return float("inf"), seed
+    return score(senders, receivers), seed
+
+
+def candidate_seeds(base_seed: int, candidates: int) -> List[int]:
+    state = np.random.SeedSequence(base_seed).generate_state(candidates, np.uint64)
+    return (state >> np.uint64(1)).astype(np.int64).tolist()
+
+
+def search_distribution(
+    user_ids,
+    k: int,
+    candidates: int,
+    base_seed: int,
+    score: Callable[[np.ndarray, np.ndarray], float] = score_reciprocal_pairs,
+    constraints: Optional[Dict] = None,
+    workers: Optional[int] = None,
+) -> Tuple[int, float, np.ndarray, np.ndarray]:
+    user_ids = np.sort(np.fromiter(user_ids, dtype=np.int64))
+    seeds = candidate_seeds(base_seed, candidates)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_search,
+        initargs=(user_ids, k, score, constraints),
+    ) as pool:
+        results = list(pool.map(_evaluate_seed, seeds))
+
+    best_score, best_seed = min(results)
+    if best_score == float("inf"):
+        raise DistributionInfeasibleError(
+            f"Ни один из {candidates} кандидатов не удовлетворяет ограничениям"
+        )
+    senders, receivers = build_distribution(user_ids, k, best_seed, constraints)
+    return best_seed, best_score, senders, receivers
+
+
+def extend_distribution(
+    existing: List[Tuple[int, int, int]],
+    new_user_ids: Iterable[int],
+    k: int,
+    rng: Optional[np.random.Generator] = None,
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    # Новичок u встраивается через k рёбер a->b со статусом 0: каждое
+    # заменяется на a->u и u->b. У a и b степени не меняются, у u выходит
+    # ровно k входящих и k исходящих. Письма в пути (статус 1 и 2) не трогаем.
+    # Отправители и адресаты новичка не пересекаются, поэтому взаимных пар
+    # с ним не появляется; запрещённые пары и своя команда отсекаются здесь.
+    rng = rng if rng is not None else np.random.default_rng()
+    banned = set(exclusions)
+    teams = teams or {}
+
+    def is_banned(a: int, b: int) -> bool:
+        team = teams.get(a)
+        return (team is not None and team == teams.get(b)) or (a, b) in banned
+
+    free = [(sender, recipient) for sender, recipient, status in existing if status == 0]
+    original = set(free)
+    removed, added = set(), set()
+
+    for u in new_user_ids:
+        picked, senders, recipients = [], set(), set()
+        tried = set()
+        for idx in chain(
+            rng.integers(len(free), size=REPAIR_TRIES).tolist() if free else [],
+            rng.permutation(len(free)).tolist(),
+        ):
+            if idx in tried:
+                continue
+            tried.add(idx)
+            a, b = free[idx]
+            if u in (a, b) or {a, b} & (senders | recipients):
+                continue
+            if is_banned(a, u) or is_banned(u, b):
+                continue
+            picked.append(idx)
+            senders.add(a)
+            recipients.add(b)
+            if len(picked) == k:
+                break
+        else:
+            raise DistributionInfeasibleError(
+                f"Не хватает подходящих свободных пар со статусом 0, чтобы добавить {u}"
+            )
+
+        for idx in sorted(picked, reverse=True):
+            edge = free[idx]
+            free[idx] = free[-1]
+            free.pop()
+            if edge in added:
+                added.discard(edge)
+            else:
+                removed.add(edge)
+        for edge in [(a, u) for a in senders] + [(u, b) for b in recipients]:
+            free.append(edge)
+            if edge in removed:
+                removed.discard(edge)
+            elif edge not in original:
+                added.add(edge)
+
+    return sorted(removed), sorted(added)
+
+
+def apply_distribution_changes(
+    removed: List[Tuple[int, int]], added: List[Tuple[int, int]]
+):
+    with transaction() as conn:
+        cursor = conn.executemany(
+            """
+            DELETE FROM distribution
+            WHERE telegram_id_sender = ? AND telegram_id_recipient = ? AND status = 0
+        """,
+            removed,
+        )
+        # Если кто-то успел отметить письмо, пока мы считали, откатываем всё.
+        if cursor.rowcount != len(removed):
+            raise RuntimeError("Распределение изменилось во время перестройки, повтори запуск")
+        conn.executemany(
+            """
+            INSERT INTO distribution (telegram_id_sender, telegram_id_recipient, status)
+            VALUES (?, ?, 0)
+        """,
+            added,
+        )
+
+
+def get_distribution_rows() -> List[Tuple[int, int, int]]:
+    with connection() as conn:
+        return conn.execute(
+            "SELECT telegram_id_sender, telegram_id_recipient, status FROM distribution"
+        ).fetchall()
+
+
+def count_violations(
+    sources: np.ndarray,
+    targets: np.ndarray,
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+) -> Dict[str, int]:
+    nodes = np.unique(np.concatenate([sources, targets]))
+    n = len(nodes)
+    source_idx = np.searchsorted(nodes, sources)
+    target_idx = np.searchsorted(nodes, targets)
+    keys = np.sort(source_idx * n + target_idx)
+    codes = _team_codes(nodes, teams)
+    return {
+        "excluded": int(np.count_nonzero(_contains(_pair_keys(nodes, exclusions), keys))),
+        "same_team": int(
+            np.count_nonzero((codes[source_idx] >= 0) & (codes[source_idx] == codes[target_idx]))
+        ),
+        "reciprocal": int(np.count_nonzero(_contains(keys, target_idx * n + source_idx))) // 2,
+    }
+
+
+def _apply_constraints(
+    result: Tuple[bool, Dict[str, int]],
+    sources: np.ndarray,
+    targets: np.ndarray,
+    exclusions,
+    teams,
+    allow_reciprocal: bool,
 ) -> Tuple[bool, Dict[str, int]]:
-    if not distribution:
-        return False, {}
+    is_valid, stats = result
+    if not exclusions and not teams and allow_reciprocal:
+        return result
+    violations = count_violations(sources, targets, exclusions, teams)
+    stats.update(violations)
+    is_valid = (
+        is_valid
+        and not violations["excluded"]
+        and not violations["same_team"]
+        and (allow_reciprocal or not violations["reciprocal"])
+    )
+    return is_valid, stats
 
-    outgoing = defaultdict(int)
-    incoming = defaultdict(int)
 
-    for sender, receivers in distribution.items():
-        outgoing[sender] = len(receivers)
-        for receiver in receivers:
-            incoming[receiver] += 1
+def verify_distribution_array(
+    senders: np.ndarray,
+    receivers: np.ndarray,
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+    allow_reciprocal: bool = True,
+) -> Tuple[bool, Dict[str, int]]:
+    if not len(senders):
+        return False, {}
 
-    outgoing_counts = list(outgoing.values())
-    incoming_counts = list(incoming.values())
+    # Исходящая степень у массива n×k одинакова по построению, поэтому
+    # считаем только входящую, самописьма и повторы внутри строки.
+    nodes = np.sort(senders)
+    target_idx = np.searchsorted(nodes, receivers.ravel())
+    known = target_idx < len(nodes)
+    known[known] = nodes[target_idx[known]] == receivers.ravel()[known]
+    incoming = np.bincount(target_idx[known], minlength=len(nodes))
 
-    all_outgoing_same = len(set(outgoing_counts)) == 1 if outgoing_counts else False
-    all_incoming_same = len(set(incoming_counts)) == 1 if incoming_counts else False
+    rows = np.sort(receivers, axis=1)
+    duplicates = int(np.count_nonzero(rows[:, 1:] == rows[:, :-1]))
+    self_loops = int(np.count_nonzero(receivers == senders[:, None]))
 
     stats = {
-        "outgoing_count": outgoing_counts[0] if outgoing_counts else 0,
-        "incoming_count": incoming_counts[0] if incoming_counts else 0,
-        "total_users": len(distribution),
+        "outgoing_count": receivers.shape[1],
+        "incoming_count": int(incoming.max()),
+        "total_users": len(senders),
+        "self_loops": self_loops,
+        "duplicates": duplicates,
     }
+    regular = bool(known.all() and incoming.min() == incoming.max())
+    return _apply_constraints(
+        (regular and not self_loops and not duplicates, stats),
+        np.repeat(senders, receivers.shape[1]),
+        receivers.ravel(),
+        list(exclusions),
+        teams,
+        allow_reciprocal,
+    )
 
-    return all_outgoing_same and all_incoming_same, stats
+
+def verify_distribution(
+    distribution: Dict[int, List[int]],
+    exclusions: Iterable[Tuple[int, int]] = (),
+    teams: Optional[Dict[int, str]] = None,
+    allow_reciprocal: bool = True,
+) -> Tuple[bool, Dict[str, int]]:
+    if not distribution:
+        return False, {}
+
+    senders = np.fromiter(distribution.keys(), dtype=np.int64, count=len(distribution))
+    lengths = [len(receivers) for receivers in distribution.values()]
+    sources = np.repeat(senders, lengths)
+    targets = np.fromiter(
+        chain.from_iterable(distribution.values()), dtype=np.int64, count=sum(lengths)
+    )
+    return _apply_constraints(
+        verify_edges(senders, sources, targets),
+        sources,
+        targets,
+        list(exclusions),
+        teams,
+        allow_reciprocal,
+    )
 
 
 def print_distribution(
@@ -120,7 +761,81 @@ def print_distribution(
         print()
 
 
+def load_teams(path: str) -> Dict[int, str]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return {int(row[0]): row[1] for row in csv.reader(f) if row}
+
+
+def load_exclusions(path: str) -> List[Tuple[int, int]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(int(row[0]), int(row[1])) for row in csv.reader(f) if row]
+
+
+def extend_main(users: List[Tuple[int, str, str]], constraints: Optional[Dict] = None):
+    constraints = constraints or {}
+    existing = get_distribution_rows()
+    if not existing:
+        print("Распределения ещё нет, запусти полную жеребьёвку")
+        return
+
+    outgoing = defaultdict(int)
+    for sender, _, _ in existing:
+        outgoing[sender] += 1
+    k = max(outgoing.values())
+    new_user_ids = [user[0] for user in users if user[0] not in outgoing]
+    if not new_user_ids:
+        print("Новых подтверждённых пользователей нет")
+        return
+
+    try:
+        removed, added = extend_distribution(
+            existing,
+            new_user_ids,
+            k,
+            exclusions=constraints.get("exclusions") or (),
+            teams=constraints.get("teams"),
+        )
+    except DistributionInfeasibleError as e:
+        print(f"⚠ Не удалось добавить новых участников: {e}")
+        return
+    apply_distribution_changes(removed, added)
+
+    print(f"Добавлено участников: {len(new_user_ids)}")
+    print(f"  Удалено пар: {len(removed)}, добавлено пар: {len(added)}")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Жеребьёвка Новогодней почты")
+    parser.add_argument("-k", type=int, default=3, help="Сколько писем пишет каждый")
+    parser.add_argument("--teams", help="CSV user_id,team: не писать своей команде")
+    parser.add_argument("--exclude", help="CSV sender_id,recipient_id: запрещённые пары")
+    parser.add_argument("--no-reciprocal", action="store_true", help="Без взаимных пар")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Добавить новых подтверждённых в текущее распределение, не пересоздавая его",
+    )
+    parser.add_argument("--seed", type=int, help="Seed жеребьёвки (для поиска — базовый)")
+    parser.add_argument(
+        "--replay", action="store_true", help="Повторить последнюю жеребьёвку по её seed"
+    )
+    parser.add_argument(
+        "--candidates", type=int, default=1, help="Сколько кандидатов перебрать параллельно"
+    )
+    parser.add_argument("--workers", type=int, help="Число процессов для поиска")
+    parser.add_argument(
+        "--score",
+        choices=["reciprocal", "teams", "cohorts"],
+        default="reciprocal",
+        help="Чем меньше значение метрики, тем лучше кандидат",
+    )
+    args = parser.parse_args()
+
+    teams = load_teams(args.teams) if args.teams else None
+    exclusions = load_exclusions(args.exclude) if args.exclude else []
+    allow_reciprocal = not args.no_reciprocal
+
+    init_db()
     users = get_all_confirmed_users()
 
     if not users:
@@ -133,15 +848,95 @@ def main():
         print("Нужно минимум 2 пользователя для распределения")
         return
 
-    recreate_distribution_table()
+    constraints = None
+    if teams or exclusions or not allow_reciprocal:
+        constraints = {
+            "exclusions": exclusions,
+            "teams": teams,
+            "allow_reciprocal": allow_reciprocal,
+        }
+
+    if args.incremental:
+        # Опоздавших встраиваем с ограничениями последней жеребьёвки, даже
+        # если флаги забыли передать
+        last = get_last_draw()
+        if last is not None and last[4] is not None:
+            try:
+                constraints = check_recorded_constraints(constraints, last[4], allow_additions=True)
+            except ValueError as e:
+                print(f"⚠ {e}: флаги могут только дополнять их")
+                return
+        extend_main(users, constraints)
+        return
 
     # k = min(5, max(1, len(users) // 4))
-    k = 3
-    distribution = create_distribution(users, k)
+    k = resolve_k(len(users), args.k)
+    user_ids = [user[0] for user in users]
 
-    save_distribution(distribution)
+    seed = args.seed if args.seed is not None else secrets.randbits(63)
+    if args.replay:
+        # Повтор перезаписывает таблицу distribution, поэтому при любом
+        # расхождении с записанной жеребьёвкой отказываемся.
+        last = get_last_draw()
+        if last is None:
+            print("Сохранённых жеребьёвок нет")
+            return
+        seed, k, user_count, _, recorded_constraints, participants = last
+        if recorded_constraints is None or participants is None:
+            print("⚠ Жеребьёвка записана без ограничений и списка участников, повторить её нельзя")
+            return
+        if participants != participants_digest(user_ids):
+            print(
+                f"⚠ Набор участников изменился (было {user_count}, сейчас {len(user_ids)}): "
+                "жеребьёвку не повторить"
+            )
+            return
+        try:
+            constraints = check_recorded_constraints(constraints, recorded_constraints)
+        except ValueError as e:
+            print(f"⚠ {e}; запусти --replay без них")
+            return
+        if constraints is not None:
+            exclusions = constraints["exclusions"]
+            teams = constraints["teams"]
+            allow_reciprocal = constraints["allow_reciprocal"]
+
+    score = None
+    try:
+        if args.candidates > 1 and not args.replay:
+            if args.score == "teams":
+                scorer = SameGroupScore(teams or {})
+            elif args.score == "cohorts":
+                scorer = SameGroupScore(get_registration_cohorts())
+            else:
+                scorer = score_reciprocal_pairs
+            seed, score, senders, receivers = search_distribution(
+                user_ids, k, args.candidates, seed, scorer, constraints, args.workers
+            )
+            print(f"Лучший из {args.candidates} кандидатов: метрика {score:g}")
+        else:
+            senders, receivers = build_distribution(user_ids, k, seed, constraints)
+    except DistributionInfeasibleError as e:
+        print(f"⚠ Распределение невозможно: {e}")
+        return
+
+    save_distribution_array(
+        senders,
+        receivers,
+        draw=(
+            seed,
+            k,
+            len(user_ids),
+            score,
+            encode_constraints(constraints),
+            participants_digest(user_ids),
+        ),
+    )
+    print(f"Seed жеребьёвки: {seed}")
 
-    is_valid, stats = verify_distribution(distribution)
+    is_valid, stats = verify_distribution_array(
+        senders, receivers, exclusions, teams, allow_reciprocal
+    )
 
     if is_valid:
         print("✓ Распределение корректно")
@@ -150,7 +945,7 @@ def main():
     else:
         print("⚠ Распределение некорректно")
 
-    print_distribution(distribution, users)
+    print_distribution(dict(zip(senders.tolist(), receivers.tolist())), users)
 
     print("\nСтатистика:")
     print(f"  Всего пользователей: {stats['total_users']}")
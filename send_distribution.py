@@ -6,7 +6,12 @@ import os
 from aiogram import Bot
 from dotenv import load_dotenv
 
-from sql import get_confirmed_users, get_recipients_for_sender, get_user_contact
+from broadcast import run_campaign
+from sql import (
+    get_campaign_progress,
+    get_recipient_contacts_by_sender,
+    init_db,
+)
 
 load_dotenv()
 
@@ -18,38 +23,48 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 
-async def send_distribution_messages(test_mode: bool = False):
+TEXT_HEADER = """Новогоднее настроение — это то, что мы создаем сами: когда покупаем подарки, слушаем новогоднюю музыку, планируем встречи… и пишем письма.
+
+Те самые — новогодние, бумажные, в которые можно вложить весь свой креатив, самые добрые и важные слова за этот год и самые теплые пожелания на следующий!
+<blockquote>А вот и твои адресаты Новогодней почты:
+"""
+
+TEXT_FOOTER = """</blockquote>Каждому из них напиши по письму и не забудь обязательно взять все на Корпорат"""
+
+
+def render_distribution_messages(recipient_contacts):
+    # Тексты собираются лениво из заранее загруженного отображения
+    # отправитель → контакты, без запросов к базе на каждого участника.
+    for user_id, contacts in recipient_contacts:
+        if not contacts:
+            logger.warning(f"У пользователя {user_id} нет получателей")
+            continue
+        yield user_id, TEXT_HEADER + "".join(f"{contact}\n" for contact in contacts) + TEXT_FOOTER
+
+
+async def send_distribution_messages(
+    test_mode: bool = False, campaign: str = "distribution", retry_failed: bool = False
+):
     bot = Bot(token=BOT_TOKEN)
     
     if test_mode:
         users = [870424192, 1291534395]
         logger.info("Режим тестирования: отправка только тестовым пользователям")
     else:
-        users = get_confirmed_users()
-    
-    for user_id in users:
-        recipients = get_recipients_for_sender(user_id)
-        
-        if not recipients:
-            logger.warning(f"У пользователя {user_id} нет получателей")
-            continue
-        
-        text = """Новогоднее настроение — это то, что мы создаем сами: когда покупаем подарки, слушаем новогоднюю музыку, планируем встречи… и пишем письма.
+        users = None
 
-Те самые — новогодние, бумажные, в которые можно вложить весь свой креатив, самые добрые и важные слова за этот год и самые теплые пожелания на следующий!
-<blockquote>А вот и твои адресаты Новогодней почты:
-"""
-        for recipient_id, first_name, last_name, username, status in recipients:
-            contact = get_user_contact(recipient_id)
-            text += f"{contact}\n"
-        
-        text += """</blockquote>Каждому из них напиши по письму и не забудь обязательно взять все на Корпорат"""
-        
-        try:
-            await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
-            logger.info(f"Сообщение отправлено пользователю {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+    recipient_contacts = get_recipient_contacts_by_sender(users)
+    messages = render_distribution_messages(recipient_contacts)
+
+    success_count, error_count = await run_campaign(
+        bot,
+        campaign,
+        messages,
+        retry_failed=retry_failed,
+        audience=(user_id for user_id, contacts in recipient_contacts if contacts),
+        parse_mode="HTML",
+    )
+    logger.info(f"Отправлено: {success_count}, ошибок: {error_count}")
     
     await bot.session.close()
 
@@ -57,7 +72,22 @@ async def send_distribution_messages(test_mode: bool = False):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", action="store_true", help="Отправить только пользователю 870424192")
+    parser.add_argument("--campaign", help="Имя рассылки в журнале доставки")
+    parser.add_argument("--retry-failed", action="store_true", help="Повторить отправку упавшим получателям")
+    parser.add_argument("--status", action="store_true", help="Показать прогресс рассылки и выйти")
     args = parser.parse_args()
+    init_db()
+    campaign = args.campaign or ("distribution-test" if args.test else "distribution")
+
+    if args.status:
+        progress = get_campaign_progress(campaign)
+        left = progress.get("pending", 0) + progress.get("retry_after", 0)
+        print(f"{progress}, осталось {left} из {sum(progress.values())}")
+        raise SystemExit
     
-    asyncio.run(send_distribution_messages(test_mode=args.test))
+    asyncio.run(
+        send_distribution_messages(
+            test_mode=args.test, campaign=campaign, retry_failed=args.retry_failed
+        )
+    )
 
@@ -2,11 +2,13 @@ import argparse
 import asyncio
 import logging
 import os
-import sqlite3
 
 from aiogram import Bot
 from dotenv import load_dotenv
 
+from broadcast import run_campaign
+from sql import connection, get_campaign_progress, init_db
+
 load_dotenv()
 
 logging.basicConfig(
@@ -15,19 +17,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-DB_NAME = "users.db"
 
 
 def get_all_senders():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT telegram_id_sender FROM distribution")
-    senders = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return senders
+    with connection() as conn:
+        rows = conn.execute("SELECT DISTINCT telegram_id_sender FROM distribution").fetchall()
+    return [row[0] for row in rows]
 
 
-async def send_reminder_messages(test_mode: bool = False):
+async def send_reminder_messages(
+    test_mode: bool = False, campaign: str = "reminder", retry_failed: bool = False
+):
     bot = Bot(token=BOT_TOKEN)
     
     if test_mode:
@@ -51,19 +51,14 @@ async def send_reminder_messages(test_mode: bool = False):
         "2. Забираешь на точке"
     )
     
-    success_count = 0
-    error_count = 0
-    
-    for i, user_id in enumerate(senders, 1):
-        try:
-            await bot.send_message(chat_id=user_id, text=message_text, request_timeout=15)
-            logger.info(f"[{i}/{len(senders)}] Сообщение отправлено пользователю {user_id}")
-            success_count += 1
-            await asyncio.sleep(0.3)
-        except Exception as e:
-            logger.error(f"[{i}/{len(senders)}] Ошибка при отправке сообщения пользователю {user_id}: {e}")
-            error_count += 1
-            await asyncio.sleep(1)
+    success_count, error_count = await run_campaign(
+        bot,
+        campaign,
+        ((user_id, message_text) for user_id in senders),
+        retry_failed=retry_failed,
+        audience=senders,
+        request_timeout=15,
+    )
     
     print(f"\n✅ Успешно отправлено: {success_count}")
     print(f"❌ Ошибок: {error_count}")
@@ -74,7 +69,22 @@ async def send_reminder_messages(test_mode: bool = False):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", action="store_true", help="Отправить только тестовым пользователям")
+    parser.add_argument("--campaign", help="Имя рассылки в журнале доставки")
+    parser.add_argument("--retry-failed", action="store_true", help="Повторить отправку упавшим получателям")
+    parser.add_argument("--status", action="store_true", help="Показать прогресс рассылки и выйти")
     args = parser.parse_args()
+    init_db()
+    campaign = args.campaign or ("reminder-test" if args.test else "reminder")
+
+    if args.status:
+        progress = get_campaign_progress(campaign)
+        left = progress.get("pending", 0) + progress.get("retry_after", 0)
+        print(f"{progress}, осталось {left} из {sum(progress.values())}")
+        raise SystemExit
     
-    asyncio.run(send_reminder_messages(test_mode=args.test))
+    asyncio.run(
+        send_reminder_messages(
+            test_mode=args.test, campaign=campaign, retry_failed=args.retry_failed
+        )
+    )
 
@@ -1,106 +1,151 @@
-import sqlite3
-from collections import defaultdict
-
-DB_NAME = "users.db"
-
-
-def get_all_distribution():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT d.telegram_id_sender, d.telegram_id_recipient
-        FROM distribution d
-        ORDER BY d.telegram_id_sender
-    """)
-    pairs = cursor.fetchall()
-    conn.close()
-    
-    distribution = defaultdict(list)
-    for sender_id, recipient_id in pairs:
-        distribution[sender_id].append(recipient_id)
-    
-    return dict(distribution)
-
-
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, first_name, last_name FROM users")
-    users = cursor.fetchall()
-    conn.close()
-    return users
-
-
-def print_distribution(distribution, users_data):
-    user_map = {user[0]: f"{user[1]} {user[2] or ''}".strip() for user in users_data}
+from itertools import groupby
+
+from sql import connection
+
+BATCH_SIZE = 1000
+
+STATUS_NAMES = {0: "не отправлено", 1: "отправлено", 2: "получено"}
+
+
+def iter_distribution(batch_size: int = BATCH_SIZE):
+    # Постраничное чтение по первичному ключу (sender, recipient): каждая
+    # страница — диапазонный запрос по индексу, в памяти не больше batch_size строк.
+    last = (-1, -1)
+    while True:
+        with connection() as conn:
+            rows = conn.execute("""
+                SELECT d.telegram_id_sender, d.telegram_id_recipient,
+                       s.first_name, s.last_name, r.first_name, r.last_name
+                FROM distribution d
+                LEFT JOIN users s ON s.user_id = d.telegram_id_sender
+                LEFT JOIN users r ON r.user_id = d.telegram_id_recipient
+                WHERE (d.telegram_id_sender, d.telegram_id_recipient) > (?, ?)
+                ORDER BY d.telegram_id_sender, d.telegram_id_recipient
+                LIMIT ?
+            """, (*last, batch_size)).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][:2]
+
+
+def _display_name(user_id, first_name, last_name):
+    if first_name is None:
+        return f"ID: {user_id}"
+    return f"{first_name} {last_name or ''}".strip()
+
+
+def get_degree_distribution(column: str):
+    # Сколько участников имеют данную степень: {степень: число участников}
+    with connection() as conn:
+        return dict(conn.execute(f"""
+            SELECT degree, COUNT(*) FROM (
+                SELECT COUNT(*) AS degree FROM distribution GROUP BY {column}
+            )
+            GROUP BY degree
+            ORDER BY degree
+        """).fetchall())
+
+
+def get_irregular_users(outgoing: int, incoming: int):
+    with connection() as conn:
+        return conn.execute("""
+            SELECT user_id, SUM(outgoing), SUM(incoming) FROM (
+                SELECT telegram_id_sender AS user_id, 1 AS outgoing, 0 AS incoming
+                FROM distribution
+                UNION ALL
+                SELECT telegram_id_recipient, 0, 1 FROM distribution
+            )
+            GROUP BY user_id
+            HAVING SUM(outgoing) != ? OR SUM(incoming) != ?
+            ORDER BY user_id
+        """, (outgoing, incoming)).fetchall()
+
+
+def get_status_breakdown():
+    with connection() as conn:
+        return dict(conn.execute(
+            "SELECT status, COUNT(*) FROM distribution GROUP BY status ORDER BY status"
+        ).fetchall())
+
+
+def _most_common(degrees):
+    return max(degrees, key=degrees.get) if degrees else None
+
+
+def calculate_stats():
+    outgoing = get_degree_distribution("telegram_id_sender")
+    incoming = get_degree_distribution("telegram_id_recipient")
+    with connection() as conn:
+        (total_users,) = conn.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT telegram_id_sender FROM distribution
+                UNION
+                SELECT telegram_id_recipient FROM distribution
+            )
+        """).fetchone()
 
-    print("\nРаспределение:\n")
-    for sender_id, receivers in sorted(distribution.items()):
-        sender_name = user_map.get(sender_id, f"ID: {sender_id}")
-        receiver_names = [user_map.get(rid, f"ID: {rid}") for rid in receivers]
-        print(f"{sender_name} (ID: {sender_id}) пишет:")
-        for name in receiver_names:
-            print(f"  - {name}")
-        print()
-
-
-def calculate_stats(distribution):
-    outgoing = defaultdict(int)
-    incoming = defaultdict(int)
+    stats = {
+        "outgoing_count": _most_common(outgoing),
+        "incoming_count": _most_common(incoming),
+        "outgoing_degrees": outgoing,
+        "incoming_degrees": incoming,
+        "total_users": total_users,
+        "statuses": get_status_breakdown(),
+    }
+    stats["irregular"] = get_irregular_users(stats["outgoing_count"], stats["incoming_count"])
 
-    for sender, receivers in distribution.items():
-        outgoing[sender] = len(receivers)
-        for receiver in receivers:
-            incoming[receiver] += 1
+    # Участник, который только пишет или только получает, тоже нерегулярен
+    is_valid = (
+        len(outgoing) == 1
+        and len(incoming) == 1
+        and not stats["irregular"]
+    )
+    return is_valid, stats
 
-    outgoing_counts = list(outgoing.values())
-    incoming_counts = list(incoming.values())
 
-    all_outgoing_same = len(set(outgoing_counts)) == 1 if outgoing_counts else False
-    all_incoming_same = len(set(incoming_counts)) == 1 if incoming_counts else False
+def print_distribution(rows):
+    print("\nРаспределение:\n")
+    for (sender_id, sender_first, sender_last), group in groupby(
+        rows, key=lambda row: (row[0], row[2], row[3])
+    ):
+        print(f"{_display_name(sender_id, sender_first, sender_last)} (ID: {sender_id}) пишет:")
+        for _, recipient_id, _, _, first_name, last_name in group:
+            print(f"  - {_display_name(recipient_id, first_name, last_name)}")
+        print()
 
-    stats = {
-        "outgoing_count": outgoing_counts[0] if outgoing_counts and all_outgoing_same else None,
-        "incoming_count": incoming_counts[0] if incoming_counts and all_incoming_same else None,
-        "total_users": len(distribution),
-    }
 
-    return all_outgoing_same and all_incoming_same, stats
+def _format_degrees(degrees):
+    return ", ".join(f"{degree}: {count}" for degree, count in degrees.items())
 
 
 def main():
-    distribution = get_all_distribution()
-    
-    if not distribution:
+    is_valid, stats = calculate_stats()
+
+    if not stats["total_users"]:
         print("Распределение не найдено в базе данных")
         return
-    
-    users = get_all_users()
-    
-    is_valid, stats = calculate_stats(distribution)
-    
+
     if is_valid:
         print("✓ Распределение корректно")
         print(f"  Каждый пишет: {stats['outgoing_count']} человек(а)")
         print(f"  Каждый получает от: {stats['incoming_count']} человек(а)")
     else:
         print("⚠ Распределение некорректно")
-    
-    print_distribution(distribution, users)
-    
+
+    print_distribution(iter_distribution())
+
     print("\nСтатистика:")
     print(f"  Всего пользователей: {stats['total_users']}")
-    if stats['outgoing_count'] is not None:
-        print(f"  Исходящих писем на человека: {stats['outgoing_count']}")
-    if stats['incoming_count'] is not None:
-        print(f"  Входящих писем на человека: {stats['incoming_count']}")
+    print(f"  Исходящих писем (степень: участников): {_format_degrees(stats['outgoing_degrees'])}")
+    print(f"  Входящих писем (степень: участников): {_format_degrees(stats['incoming_degrees'])}")
+    for status, count in stats["statuses"].items():
+        print(f"  Статус «{STATUS_NAMES.get(status, status)}»: {count}")
+    if stats["irregular"]:
+        print("  Нерегулярные участники (ID: пишет/получает):")
+        for user_id, outgoing, incoming in stats["irregular"]:
+            print(f"    {user_id}: {outgoing}/{incoming}")
 
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
@@ -1,13 +1,340 @@
+import functools
+import json
+import logging
+import queue
 import sqlite3
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, Optional, Tuple
 
 DB_NAME = "users.db"
 
+# Порог медленного запроса в миллисекундах; None — журнал выключен
+SLOW_QUERY_MS: Optional[float] = None
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
+slow_query_logger = logging.getLogger("sql.slow")
+
+POOL_SIZE = 4
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+CONTACT_CACHE_SIZE = 4096
+
+_pools: dict[str, queue.LifoQueue] = {}
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Отформатированные контакты меняются только при обновлении профиля, поэтому
+# кэшируются в процессе; любая запись в users должна вызывать invalidate_contact.
+_contact_cache = LRUCache(CONTACT_CACHE_SIZE)
+
+# Счётчики по функциям модуля: вызовы, выполненные запросы и время.
+# Запросы считает InstrumentedConnection в пределах текущего потока.
+_local = threading.local()
+_function_stats: dict[str, list] = {}
+_function_stats_lock = threading.Lock()
+
+
+def _shape(parameters) -> str:
+    # Только типы и размеры: значения (имена, id) в журнал не пишем
+    if isinstance(parameters, dict):
+        items = [f"{key}: {_shape_value(value)}" for key, value in parameters.items()]
+        return "{" + ", ".join(items) + "}"
+    return "(" + ", ".join(_shape_value(value) for value in parameters) + ")"
+
+
+def _shape_value(value) -> str:
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def _log_slow_query(sql: str, shape: str, elapsed: float):
+    function = getattr(_local, "function", None) or "?"
+    slow_query_logger.warning(
+        f"Медленный запрос {elapsed * 1000:.1f} мс в {function}, "
+        f"параметры {shape}: {' '.join(sql.split())}"
+    )
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Для SELECT замеряется выполнение до первой строки: сортировка и
+    # группировка попадают в замер, дальнейший fetch — нет.
+    def execute(self, sql, parameters=(), /):
+        _local.queries = getattr(_local, "queries", 0) + 1
+        if SLOW_QUERY_MS is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                _log_slow_query(sql, _shape(parameters), elapsed)
+
+    def executemany(self, sql, parameters, /):
+        _local.queries = getattr(_local, "queries", 0) + 1
+        if SLOW_QUERY_MS is None:
+            return super().executemany(sql, parameters)
+        count = 0
+        first = None
+
+        def counted():
+            nonlocal count, first
+            for row in parameters:
+                if first is None:
+                    first = _shape(row)
+                count += 1
+                yield row
+
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, counted())
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                _log_slow_query(sql, f"{count} x {first or '()'}", elapsed)
+
+
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        queries = getattr(_local, "queries", 0)
+        caller = getattr(_local, "function", None)
+        _local.function = func.__name__
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _local.function = caller
+            queries = getattr(_local, "queries", 0) - queries
+            with _function_stats_lock:
+                stats = _function_stats.setdefault(func.__name__, [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += queries
+                stats[2] += elapsed
+
+    return wrapper
+
+
+def function_stats():
+    # {функция: (вызовов, запросов, секунд)}
+    with _function_stats_lock:
+        return {name: tuple(stats) for name, stats in _function_stats.items()}
+
+
+def _connect(db_name: str) -> sqlite3.Connection:
+    # Соединения живут долго, поэтому кэш подготовленных выражений sqlite3
+    # переиспользуется между вызовами, а не собирается заново каждый раз.
+    conn = sqlite3.connect(
+        db_name,
+        check_same_thread=False,
+        cached_statements=256,
+        factory=InstrumentedConnection,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _pool() -> queue.LifoQueue:
+    return _pools.setdefault(DB_NAME, queue.LifoQueue(maxsize=POOL_SIZE))
+
+
+@contextmanager
+def connection():
+    pool = _pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _connect(DB_NAME)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@contextmanager
+def transaction(immediate: bool = False):
+    # Явный BEGIN, чтобы DDL (DROP/CREATE) тоже попадал в транзакцию:
+    # sqlite3 сам открывает её только перед DML. Если транзакция сначала
+    # читает, а потом пишет, нужен immediate=True, иначе в WAL запись после
+    # чужого коммита падает с SQLITE_BUSY без ожидания.
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        with conn:
+            yield conn
+
+
+def close_connections():
+    for pool in _pools.values():
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+    _pools.clear()
+    _contact_cache.invalidate()
+
+
+def create_distribution_indexes(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_distribution_recipient_status
+        ON distribution (telegram_id_recipient, status, telegram_id_sender)
+    """)
+    # Вместе с индексом выше покрывают постраничный обход писем со статусом
+    # в порядке (sender, recipient) без сортировки, в том числе с фильтром.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_distribution_status_sender
+        ON distribution (status, telegram_id_sender, telegram_id_recipient)
+    """)
+
+
+# Счётчики в таблице stats поддерживаются триггерами, поэтому сводка по
+# событию читается одним запросом без прохода по distribution и users.
+# Ключи: distribution.status.<status> и users.confirmed.<0|1>.
+def create_distribution_triggers(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_distribution_insert_stats
+        AFTER INSERT ON distribution
+        BEGIN
+            INSERT INTO stats (name, value)
+            VALUES ('distribution.status.' || COALESCE(NEW.status, 0), 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_distribution_delete_stats
+        AFTER DELETE ON distribution
+        BEGIN
+            UPDATE stats SET value = value - 1
+            WHERE name = 'distribution.status.' || COALESCE(OLD.status, 0);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_distribution_update_stats
+        AFTER UPDATE OF status ON distribution
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE stats SET value = value - 1
+            WHERE name = 'distribution.status.' || COALESCE(OLD.status, 0);
+            INSERT INTO stats (name, value)
+            VALUES ('distribution.status.' || COALESCE(NEW.status, 0), 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+    """)
+
+
+def create_user_triggers(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats
+        AFTER INSERT ON users
+        BEGIN
+            INSERT INTO stats (name, value)
+            VALUES ('users.confirmed.' || (COALESCE(NEW.confirmed, 0) != 0), 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats
+        AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET value = value - 1
+            WHERE name = 'users.confirmed.' || (COALESCE(OLD.confirmed, 0) != 0);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_update_stats
+        AFTER UPDATE OF confirmed ON users
+        WHEN (COALESCE(OLD.confirmed, 0) != 0) != (COALESCE(NEW.confirmed, 0) != 0)
+        BEGIN
+            UPDATE stats SET value = value - 1
+            WHERE name = 'users.confirmed.' || (COALESCE(OLD.confirmed, 0) != 0);
+            INSERT INTO stats (name, value)
+            VALUES ('users.confirmed.' || (COALESCE(NEW.confirmed, 0) != 0), 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+    """)
+
+
+def rebuild_distribution_stats(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM stats WHERE name LIKE 'distribution.%'")
+    conn.execute("""
+        INSERT INTO stats (name, value)
+        SELECT 'distribution.status.' || COALESCE(status, 0), COUNT(*)
+        FROM distribution GROUP BY COALESCE(status, 0)
+    """)
+
+
+def rebuild_user_stats(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM stats WHERE name LIKE 'users.%'")
+    conn.execute("""
+        INSERT INTO stats (name, value)
+        SELECT 'users.confirmed.' || (COALESCE(confirmed, 0) != 0), COUNT(*)
+        FROM users GROUP BY COALESCE(confirmed, 0) != 0
+    """)
+
+
+def _migration_base_schema(conn: sqlite3.Connection):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -17,7 +344,7 @@ def init_db():
             confirmed BOOLEAN DEFAULT 0
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS distribution (
             telegram_id_sender INTEGER NOT NULL,
             telegram_id_recipient INTEGER NOT NULL,
@@ -25,145 +352,609 @@ def init_db():
             PRIMARY KEY (telegram_id_sender, telegram_id_recipient)
         )
     """)
-    conn.commit()
-    conn.close()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY,
+            recipient_id INTEGER NOT NULL,
+            due_at REAL NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notifications_due_at ON notifications (due_at)"
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_log (
+            campaign TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            retry_at REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (campaign, chat_id)
+        )
+    """)
+
+
+def _migration_indexes(conn: sqlite3.Connection):
+    create_distribution_indexes(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_confirmed ON users (confirmed)")
+
+
+def _migration_draws(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS draws (
+            id INTEGER PRIMARY KEY,
+            seed INTEGER NOT NULL,
+            k INTEGER NOT NULL,
+            user_count INTEGER NOT NULL,
+            score REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _migration_stats(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    create_distribution_triggers(conn)
+    create_user_triggers(conn)
+    rebuild_distribution_stats(conn)
+    rebuild_user_stats(conn)
+
+
+def _migration_pending_index(conn: sqlite3.Connection):
+    conn.execute("DROP INDEX IF EXISTS idx_distribution_status")
+    conn.execute("DROP INDEX IF EXISTS idx_distribution_recipient_status")
+    create_distribution_indexes(conn)
+
+
+def _migration_coalesce_notifications(conn: sqlite3.Connection):
+    # Одна строка очереди на получателя: повторные подтверждения только
+    # увеличивают счётчик писем, а уже выбранная задержка сохраняется.
+    conn.execute("ALTER TABLE notifications ADD COLUMN letters INTEGER NOT NULL DEFAULT 1")
+    conn.execute("""
+        UPDATE notifications
+        SET letters = (
+                SELECT COUNT(*) FROM notifications n
+                WHERE n.recipient_id = notifications.recipient_id
+            ),
+            due_at = (
+                SELECT MIN(n.due_at) FROM notifications n
+                WHERE n.recipient_id = notifications.recipient_id
+            )
+        WHERE id IN (SELECT MIN(id) FROM notifications GROUP BY recipient_id)
+    """)
+    conn.execute("""
+        DELETE FROM notifications
+        WHERE id NOT IN (SELECT MIN(id) FROM notifications GROUP BY recipient_id)
+    """)
+    conn.execute(
+        "CREATE UNIQUE INDEX idx_notifications_recipient ON notifications (recipient_id)"
+    )
+
 
+def _migration_draw_constraints(conn: sqlite3.Connection):
+    # Без ограничений и набора участников seed не воспроизводит жеребьёвку
+    conn.execute("ALTER TABLE draws ADD COLUMN constraints TEXT")
+    conn.execute("ALTER TABLE draws ADD COLUMN participants TEXT")
 
+
+def _migration_notification_attempts(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE notifications ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_distribution_notified(conn: sqlite3.Connection):
+    # Отметка, что о письме уже поставлено уведомление. Забранные письма
+    # считаем уведомлёнными, об отмеченных (status = 1) лучше напомнить ещё раз.
+    conn.execute("ALTER TABLE distribution ADD COLUMN notified INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE distribution SET notified = 1 WHERE status = 2")
+
+
+# Каждая миграция применяется ровно один раз; номер последней применённой
+# хранится в PRAGMA user_version. Новые миграции только дописываются в конец.
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_indexes,
+    _migration_draws,
+    _migration_stats,
+    _migration_pending_index,
+    _migration_coalesce_notifications,
+    _migration_draw_constraints,
+    _migration_notification_attempts,
+    _migration_distribution_notified,
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(target: Optional[int] = None):
+    target = len(MIGRATIONS) if target is None else target
+    while True:
+        with transaction(immediate=True) as conn:
+            version = get_schema_version(conn)
+            if version >= target:
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+
+
+def init_db():
+    migrate()
+
+
+@instrumented
 def add_user(
     user_id: int,
     username: Optional[str],
     first_name: Optional[str],
     last_name: Optional[str] = None,
 ):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-    """,
-        (user_id, username, first_name, last_name),
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+        """,
+            (user_id, username, first_name, last_name),
+        )
+    invalidate_contact(user_id)
 
 
+@instrumented
 def confirm_user(user_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-    """
-        UPDATE users SET confirmed = 1 WHERE user_id = ?
-    """,
-        (user_id,),
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            """
+            UPDATE users SET confirmed = 1 WHERE user_id = ?
+        """,
+            (user_id,),
+        )
 
 
+@instrumented
 def is_confirmed(user_id: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT confirmed FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        result = conn.execute(
+            "SELECT confirmed FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
     return result[0] if result else False
 
 
+@instrumented
 def get_confirmed_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE confirmed = 1")
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return users
+    with connection() as conn:
+        rows = conn.execute("SELECT user_id FROM users WHERE confirmed = 1").fetchall()
+    return [row[0] for row in rows]
 
 
+@instrumented
 def get_recipients_for_sender(sender_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
+    with connection() as conn:
+        return conn.execute("""
+            SELECT d.telegram_id_recipient, u.first_name, u.last_name, u.username, d.status
+            FROM distribution d
+            JOIN users u ON d.telegram_id_recipient = u.user_id
+            WHERE d.telegram_id_sender = ?
+        """, (sender_id,)).fetchall()
+
+
+def format_contact(
+    first_name: Optional[str], last_name: Optional[str], username: Optional[str]
+) -> str:
+    if username:
+        return f"@{username}" if not username.startswith("@") else username
+    return f"{first_name} {last_name or ''}".strip()
+
+
+@instrumented
+def get_recipient_contacts_by_sender(sender_ids: Optional[Iterable[int]] = None):
+    # Все пары отправитель → контакт получателя одним запросом; по умолчанию
+    # для всех подтвердивших. Отправители без получателей тоже попадают
+    # в результат — с пустым списком.
+    if sender_ids is None:
+        senders, params = "SELECT user_id AS id FROM users WHERE confirmed = 1", ()
+    else:
+        senders, params = "SELECT value AS id FROM json_each(?)", (json.dumps(list(sender_ids)),)
+    with connection() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT s.id, u.user_id, u.first_name, u.last_name, u.username
+            FROM ({senders}) s
+            LEFT JOIN distribution d ON d.telegram_id_sender = s.id
+            LEFT JOIN users u ON u.user_id = d.telegram_id_recipient
+            ORDER BY s.id, d.telegram_id_recipient
+        """,
+            params,
+        ).fetchall()
+    return [
+        (
+            sender_id,
+            [format_contact(*row[2:]) for row in group if row[1] is not None],
+        )
+        for sender_id, group in groupby(rows, key=itemgetter(0))
+    ]
+
+
+def _select_recipient_contacts(conn: sqlite3.Connection, sender_id: int):
+    rows = conn.execute("""
         SELECT d.telegram_id_recipient, u.first_name, u.last_name, u.username, d.status
         FROM distribution d
         JOIN users u ON d.telegram_id_recipient = u.user_id
         WHERE d.telegram_id_sender = ?
-    """, (sender_id,))
-    recipients = cursor.fetchall()
-    conn.close()
-    return recipients
+    """, (sender_id,)).fetchall()
+    return [
+        (recipient_id, format_contact(first_name, last_name, username), status)
+        for recipient_id, first_name, last_name, username, status in rows
+    ]
+
+
+@instrumented
+def get_recipient_contacts(sender_id: int):
+    with connection() as conn:
+        return _select_recipient_contacts(conn, sender_id)
+
+
+@instrumented
+def update_distribution_statuses(sender_id: int, recipient_ids, status: int) -> int:
+    # Список получателей передаётся одним JSON-параметром, так что текст
+    # запроса не зависит от их количества и подготовленное выражение кэшируется.
+    with transaction() as conn:
+        cursor = conn.execute("""
+            UPDATE distribution SET status = ?
+            WHERE telegram_id_sender = ?
+              AND telegram_id_recipient IN (SELECT value FROM json_each(?))
+        """, (status, sender_id, json.dumps(list(recipient_ids))))
+        return cursor.rowcount
+
+
+@instrumented
+def set_sender_status(sender_id: int, status: int) -> int:
+    with transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE distribution SET status = ? WHERE telegram_id_sender = ?",
+            (status, sender_id),
+        )
+        return cursor.rowcount
+
+
+@instrumented
+def toggle_distribution_status(sender_id: int, recipient_id: int):
+    # Переключение 0 <-> 1 делается одним UPDATE, поэтому два быстрых нажатия
+    # не читают один и тот же статус. Полученные письма (status = 2) не трогаем.
+    with transaction() as conn:
+        row = conn.execute("""
+            UPDATE distribution SET status = 1 - status
+            WHERE telegram_id_sender = ? AND telegram_id_recipient = ? AND status IN (0, 1)
+            RETURNING status
+        """, (sender_id, recipient_id)).fetchone()
+        if row is None:
+            return None, []
+        return row[0], _select_recipient_contacts(conn, sender_id)
+
+
+def invalidate_contact(user_id: Optional[int] = None):
+    # Без аргумента сбрасывает кэш целиком
+    _contact_cache.invalidate(user_id)
 
 
+def contact_cache_stats():
+    return _contact_cache.stats()
+
+
+@instrumented
 def get_user_contact(user_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT first_name, last_name, username FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        name = f"{result[0]} {result[1] or ''}".strip()
-        username = result[2]
-        if username:
-            return f"@{username}" if not username.startswith("@") else username
-        return name
-    return f"ID: {user_id}"
+    contact = _contact_cache.get(user_id)
+    if contact is not None:
+        return contact
+    with connection() as conn:
+        result = conn.execute(
+            "SELECT first_name, last_name, username FROM users WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    # Незарегистрированных не кэшируем: они могут появиться в обход add_user
+    if result is None:
+        return f"ID: {user_id}"
+    contact = format_contact(*result)
+    _contact_cache.put(user_id, contact)
+    return contact
 
 
+@instrumented
 def update_distribution_status(sender_id: int, recipient_id: int, status: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE distribution SET status = ? 
-        WHERE telegram_id_sender = ? AND telegram_id_recipient = ?
-    """, (status, sender_id, recipient_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE distribution SET status = ?
+            WHERE telegram_id_sender = ? AND telegram_id_recipient = ?
+        """, (status, sender_id, recipient_id))
 
 
+@instrumented
 def take_letters_for_recipient(recipient_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT telegram_id_sender
-        FROM distribution
-        WHERE telegram_id_recipient = ? AND status = 1
-    """,
-        (recipient_id,),
-    )
-    senders = [row[0] for row in cursor.fetchall()]
-    cursor.execute(
+    # Один UPDATE ... RETURNING вместо SELECT и UPDATE: в WAL отложенная
+    # транзакция, прочитавшая данные до чужого коммита, не может стать
+    # пишущей и сразу падает с "database is locked", busy_timeout не помогает.
+    with transaction() as conn:
+        rows = conn.execute(
+            """
+            UPDATE distribution SET status = 2
+            WHERE telegram_id_recipient = ? AND status = 1
+            RETURNING telegram_id_sender
+        """,
+            (recipient_id,),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+@instrumented
+def get_pending_letters_page(
+    cursor: Optional[Tuple[int, int]] = None,
+    backward: bool = False,
+    limit: int = 20,
+    sender_id: Optional[int] = None,
+    recipient_id: Optional[int] = None,
+):
+    # Keyset-пагинация по (sender, recipient): страница после курсора или,
+    # при backward, перед ним. Берём на одну строку больше, чтобы узнать,
+    # есть ли ещё страница в этом направлении.
+    conditions = ["d.status = 1"]
+    params = []
+    if sender_id is not None:
+        conditions.append("d.telegram_id_sender = ?")
+        params.append(sender_id)
+    if recipient_id is not None:
+        conditions.append("d.telegram_id_recipient = ?")
+        params.append(recipient_id)
+    if cursor is not None:
+        # С фильтром одна из колонок курсора фиксирована, и сравнение только
+        # по второй даёт планировщику точный диапазон по индексу.
+        op = "<" if backward else ">"
+        if sender_id is not None:
+            conditions.append(f"d.telegram_id_recipient {op} ?")
+            params.append(cursor[1])
+        elif recipient_id is not None:
+            conditions.append(f"d.telegram_id_sender {op} ?")
+            params.append(cursor[0])
+        else:
+            conditions.append(f"(d.telegram_id_sender, d.telegram_id_recipient) {op} (?, ?)")
+            params.extend(cursor)
+    order = "DESC" if backward else "ASC"
+
+    with connection() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT
+                d.telegram_id_sender,
+                us.username,
+                us.first_name,
+                us.last_name,
+                d.telegram_id_recipient,
+                ur.username,
+                ur.first_name,
+                ur.last_name
+            FROM distribution d
+            JOIN users us ON us.user_id = d.telegram_id_sender
+            JOIN users ur ON ur.user_id = d.telegram_id_recipient
+            WHERE {" AND ".join(conditions)}
+            ORDER BY d.telegram_id_sender {order}, d.telegram_id_recipient {order}
+            LIMIT ?
+        """,
+            (*params, limit + 1),
+        ).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+@instrumented
+def schedule_notifications(sender_id: int, notifications) -> int:
+    # notifications — пары (получатель, due_at) для писем, отмеченных
+    # отправителем. В очередь попадают только письма, о которых ещё не
+    # уведомляли, поэтому повторное подтверждение не считает их заново.
+    due_at = dict(notifications)
+    with transaction() as conn:
+        recipients = [
+            row[0]
+            for row in conn.execute(
+                """
+                UPDATE distribution SET notified = 1
+                WHERE telegram_id_sender = ?
+                  AND telegram_id_recipient IN (SELECT value FROM json_each(?))
+                  AND status = 1 AND notified = 0
+                RETURNING telegram_id_recipient
+            """,
+                (sender_id, json.dumps(list(due_at))),
+            ).fetchall()
+        ]
+        conn.executemany(
+            """
+            INSERT INTO notifications (recipient_id, due_at) VALUES (?, ?)
+            ON CONFLICT (recipient_id) DO UPDATE SET letters = letters + 1
+        """,
+            ((recipient_id, due_at[recipient_id]) for recipient_id in recipients),
+        )
+    return len(recipients)
+
+
+@instrumented
+def get_due_notifications(now: float, limit: int):
+    with connection() as conn:
+        return conn.execute(
+            """
+            SELECT id, recipient_id, letters
+            FROM notifications
+            WHERE due_at <= ?
+            ORDER BY due_at
+            LIMIT ?
+        """,
+            (now, limit),
+        ).fetchall()
+
+
+@instrumented
+def get_next_notification_due() -> Optional[float]:
+    with connection() as conn:
+        return conn.execute("SELECT MIN(due_at) FROM notifications").fetchone()[0]
+
+
+@instrumented
+def complete_notifications(notifications, reschedule_at: float):
+    # notifications — пары (id, сколько писем покрыло отправленное уведомление).
+    # Если за время отправки получателю подтвердили ещё письма, строка
+    # остаётся с остатком и переносится на reschedule_at.
+    notifications = list(notifications)
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE notifications SET letters = letters - ?, due_at = ? WHERE id = ?",
+            ((letters, reschedule_at, notification_id) for notification_id, letters in notifications),
+        )
+        conn.execute(
+            """
+            DELETE FROM notifications
+            WHERE id IN (SELECT value FROM json_each(?)) AND letters <= 0
+        """,
+            (json.dumps([notification_id for notification_id, _ in notifications]),),
+        )
+
+
+@instrumented
+def postpone_notifications(notifications, max_attempts: int) -> int:
+    # notifications — пары (id, новый due_at) для уведомлений, которые не
+    # удалось отправить. После max_attempts неудач строка удаляется;
+    # возвращает число удалённых.
+    notifications = list(notifications)
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE notifications SET due_at = ?, attempts = attempts + 1 WHERE id = ?",
+            ((due_at, notification_id) for notification_id, due_at in notifications),
+        )
+        return conn.execute(
+            """
+            DELETE FROM notifications
+            WHERE id IN (SELECT value FROM json_each(?)) AND attempts >= ?
+        """,
+            (json.dumps([notification_id for notification_id, _ in notifications]), max_attempts),
+        ).rowcount
+
+
+@instrumented
+def delete_notifications(notification_ids):
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM notifications WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(notification_ids)),),
+        )
+
+
+@instrumented
+def enqueue_campaign(campaign: str, chat_ids):
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_log (campaign, chat_id) VALUES (?, ?)",
+            ((campaign, chat_id) for chat_id in chat_ids),
+        )
+
+
+@instrumented
+def get_campaign_chats(campaign: str, states):
+    with connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT chat_id FROM broadcast_log
+            WHERE campaign = ? AND state IN (SELECT value FROM json_each(?))
+        """,
+            (campaign, json.dumps(list(states))),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+@instrumented
+def record_delivery(
+    campaign: str,
+    chat_id: int,
+    state: str,
+    error: Optional[str] = None,
+    retry_at: Optional[float] = None,
+):
+    # Строка журнала создаётся при первой попытке, если чат не был заранее
+    # поставлен в очередь через enqueue_campaign.
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO broadcast_log (campaign, chat_id, state, error, retry_at, attempts)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (campaign, chat_id) DO UPDATE
+            SET state = excluded.state, error = excluded.error, retry_at = excluded.retry_at,
+                attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        """,
+            (campaign, chat_id, state, error, retry_at),
+        )
+
+
+@instrumented
+def get_campaign_progress(campaign: str):
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT state, COUNT(*) FROM broadcast_log WHERE campaign = ? GROUP BY state",
+            (campaign,),
+        ).fetchall()
+    return dict(rows)
+
+
+def insert_draw(
+    conn: sqlite3.Connection,
+    seed: int,
+    k: int,
+    user_count: int,
+    score: Optional[float] = None,
+    constraints: Optional[str] = None,
+    participants: Optional[str] = None,
+):
+    # Принимает соединение, чтобы запись о жеребьёвке попадала в одну
+    # транзакцию с сохранением самого распределения.
+    conn.execute(
         """
-        UPDATE distribution SET status = 2
-        WHERE telegram_id_recipient = ? AND status = 1
+        INSERT INTO draws (seed, k, user_count, score, constraints, participants)
+        VALUES (?, ?, ?, ?, ?, ?)
     """,
-        (recipient_id,),
+        (seed, k, user_count, score, constraints, participants),
     )
-    conn.commit()
-    conn.close()
-    return senders
 
 
-def get_pending_letters():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+@instrumented
+def record_draw(
+    seed: int,
+    k: int,
+    user_count: int,
+    score: Optional[float] = None,
+    constraints: Optional[str] = None,
+    participants: Optional[str] = None,
+):
+    with transaction() as conn:
+        insert_draw(conn, seed, k, user_count, score, constraints, participants)
+
+
+@instrumented
+def get_last_draw():
+    with connection() as conn:
+        return conn.execute(
+            """
+            SELECT seed, k, user_count, score, constraints, participants
+            FROM draws ORDER BY id DESC LIMIT 1
         """
-        SELECT
-            d.telegram_id_sender,
-            us.username,
-            us.first_name,
-            us.last_name,
-            d.telegram_id_recipient,
-            ur.username,
-            ur.first_name,
-            ur.last_name
-        FROM distribution d
-        JOIN users us ON us.user_id = d.telegram_id_sender
-        JOIN users ur ON ur.user_id = d.telegram_id_recipient
-        WHERE d.status = 1
-        ORDER BY d.telegram_id_sender, d.telegram_id_recipient
-    """
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+        ).fetchone()
+
+
+@instrumented
+def get_stats():
+    with connection() as conn:
+        return dict(conn.execute("SELECT name, value FROM stats").fetchall())
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendMessage
+
+import broadcast
+import sql
+from broadcast import Broadcaster, TokenBucket, run_campaign
+
+
+class FakeBot:
+    def __init__(self, failures=None):
+        self.sent = []
+        self.calls = []
+        self.failures = failures or {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(chat_id)
+        errors = self.failures.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text, kwargs))
+
+
+def method(chat_id):
+    return SendMessage(chat_id=chat_id, text="test")
+
+
+def test_token_bucket_limits_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=100, capacity=1)
+        start = time.monotonic()
+        for _ in range(21):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) >= 0.19
+
+
+def test_broadcast_sends_everything():
+    bot = FakeBot()
+    broadcaster = Broadcaster(bot, rate=1000, concurrency=5)
+
+    result = asyncio.run(
+        broadcaster.run(((i, f"text {i}") for i in range(50)), parse_mode="HTML")
+    )
+
+    assert result == (50, 0)
+    assert sorted(chat_id for chat_id, _, _ in bot.sent) == list(range(50))
+    assert all(kwargs == {"parse_mode": "HTML"} for _, _, kwargs in bot.sent)
+
+
+def test_broadcast_retries_flood_wait_and_server_errors(monkeypatch):
+    monkeypatch.setattr(broadcast, "BACKOFF_BASE", 0.01)
+    bot = FakeBot(
+        failures={
+            1: [TelegramRetryAfter(method(1), "Too Many Requests", 0)],
+            2: [TelegramServerError(method(2), "Bad Gateway")],
+        }
+    )
+    broadcaster = Broadcaster(bot, rate=1000, per_chat_interval=0.01)
+
+    assert asyncio.run(broadcaster.run([(1, "a"), (2, "b"), (3, "c")])) == (3, 0)
+    assert bot.calls.count(1) == 2
+    assert bot.calls.count(2) == 2
+
+
+def test_broadcast_gives_up_on_permanent_errors():
+    results = []
+
+    async def on_result(chat_id, ok, error):
+        results.append((chat_id, ok))
+
+    bot = FakeBot(failures={1: [TelegramForbiddenError(method(1), "bot was blocked")]})
+    broadcaster = Broadcaster(bot, rate=1000, on_result=on_result)
+
+    assert asyncio.run(broadcaster.run([(1, "a"), (2, "b")])) == (1, 1)
+    assert bot.calls.count(1) == 1
+    assert sorted(results) == [(1, False), (2, True)]
+
+
+def test_broadcast_survives_failing_callback():
+    async def on_result(chat_id, ok, error):
+        if chat_id == 1:
+            raise RuntimeError("database is locked")
+
+    bot = FakeBot()
+    broadcaster = Broadcaster(bot, rate=1000, concurrency=2, on_result=on_result)
+
+    assert asyncio.run(broadcaster.run((i, "a") for i in range(10))) == (10, 0)
+    assert sorted(bot.calls) == list(range(10))
+
+
+def test_campaign_enqueues_audience(db):
+    progress = []
+
+    class ProgressBot(FakeBot):
+        async def send_message(self, chat_id, text, **kwargs):
+            progress.append(sql.get_campaign_progress("reminder"))
+            await super().send_message(chat_id, text, **kwargs)
+
+    sql.record_delivery("reminder", 1, "sent")
+    messages = ((i, f"text {i}") for i in range(1, 4))
+
+    assert asyncio.run(run_campaign(ProgressBot(), "reminder", messages, audience=range(1, 6))) == (2, 0)
+    # Ещё не отправленные чаты видны в журнале как pending
+    assert progress[0] == {"sent": 1, "pending": 4}
+    assert sql.get_campaign_progress("reminder") == {"sent": 3, "pending": 2}
+
+
+def test_campaign_resumes_from_journal(db):
+    messages = [(i, f"text {i}") for i in range(1, 6)]
+    bot = FakeBot(failures={2: [TelegramForbiddenError(method(2), "bot was blocked")]})
+    sql.record_delivery("reminder", 1, "sent")
+
+    assert asyncio.run(run_campaign(bot, "reminder", messages)) == (3, 1)
+    assert sorted(bot.calls) == [2, 3, 4, 5]
+    assert sql.get_campaign_progress("reminder") == {"sent": 4, "failed": 1}
+
+    bot.calls.clear()
+    assert asyncio.run(run_campaign(bot, "reminder", messages)) == (0, 0)
+    assert asyncio.run(run_campaign(bot, "reminder", messages, retry_failed=True)) == (1, 0)
+    assert bot.calls == [2]
+    assert sql.get_campaign_progress("reminder") == {"sent": 5}
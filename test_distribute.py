@@ -1,7 +1,32 @@
 import logging
+import sqlite3
 from collections import defaultdict
 
-from distribute import create_distribution, verify_distribution
+import numpy as np
+import pytest
+
+from distribute import (
+    DistributionInfeasibleError,
+    SameGroupScore,
+    apply_distribution_changes,
+    check_recorded_constraints,
+    build_distribution,
+    create_constrained_distribution,
+    create_constrained_distribution_array,
+    create_distribution,
+    create_distribution_array,
+    decode_constraints,
+    encode_constraints,
+    extend_distribution,
+    get_distribution_rows,
+    participants_digest,
+    save_distribution,
+    save_distribution_array,
+    search_distribution,
+    verify_distribution,
+    verify_distribution_array,
+)
+from sql import connection, get_last_draw, get_stats, record_draw
 
 logging.basicConfig(
     level=logging.INFO,
@@ -288,3 +313,282 @@ def test_twenty_users():
         f"Статистика: исходящих={stats['outgoing_count']}, входящих={stats['incoming_count']}"
     )
     log_pairs(distribution)
+
+
+def test_save_distribution_builds_indexes(db):
+    users = [(i, f"User{i}", f"Last{i}") for i in range(1, 11)]
+    distribution = create_distribution(users, k=3)
+    save_distribution(distribution)
+    save_distribution(distribution)
+
+    with connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM distribution").fetchone()[0]
+        indexes = {
+            row[0]
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'distribution' AND sql IS NOT NULL"
+            )
+        }
+    assert count == 30
+    assert indexes == {"idx_distribution_recipient_status", "idx_distribution_status_sender"}
+    assert get_stats()["distribution.status.0"] == 30
+
+
+def test_distribution_array_shape():
+    senders, receivers = create_distribution_array(list(range(1, 101)), 10)
+
+    assert senders.shape == (100,)
+    assert receivers.shape == (100, 10)
+    assert sorted(senders.tolist()) == list(range(1, 101))
+
+    is_valid, stats = verify_distribution_array(senders, receivers)
+    assert is_valid
+    assert stats["outgoing_count"] == 10
+    assert stats["incoming_count"] == 10
+    assert stats["self_loops"] == 0
+    assert stats["duplicates"] == 0
+
+
+def test_distribution_array_is_reproducible_with_rng():
+    first = create_distribution_array([5, 3, 1, 4, 2], 2, np.random.default_rng(7))
+    second = create_distribution_array([1, 2, 3, 4, 5], 2, np.random.default_rng(7))
+
+    assert np.array_equal(first[0], second[0])
+    assert np.array_equal(first[1], second[1])
+
+
+def test_verify_detects_self_loops_and_duplicates():
+    is_valid, stats = verify_distribution({1: [1, 2], 2: [1, 2]})
+    assert not is_valid
+    assert stats["self_loops"] == 2
+
+    is_valid, stats = verify_distribution({1: [2, 2], 2: [1, 1]})
+    assert not is_valid
+    assert stats["duplicates"] == 2
+
+
+def test_verify_detects_irregular_degrees():
+    is_valid, stats = verify_distribution({1: [2], 2: [1], 3: [1]})
+    assert not is_valid
+    assert stats["total_users"] == 3
+
+
+def test_constrained_distribution_respects_teams_and_exclusions():
+    users = [(i, f"User{i}", f"Last{i}") for i in range(1, 41)]
+    teams = {i: f"team{i % 4}" for i in range(1, 41)}
+    exclusions = [(1, 2), (2, 3), (3, 4), (10, 11)]
+    distribution = create_constrained_distribution(
+        users, k=5, exclusions=exclusions, teams=teams, allow_reciprocal=False
+    )
+
+    assert len(distribution) == 40
+    for sender, receivers in distribution.items():
+        assert all(teams[sender] != teams[receiver] for receiver in receivers)
+        assert all((sender, receiver) not in exclusions for receiver in receivers)
+
+    is_valid, stats = verify_distribution(
+        distribution, exclusions=exclusions, teams=teams, allow_reciprocal=False
+    )
+    assert is_valid
+    assert stats["outgoing_count"] == 5
+    assert stats["incoming_count"] == 5
+    assert stats["excluded"] == 0
+    assert stats["same_team"] == 0
+    assert stats["reciprocal"] == 0
+
+
+def test_constrained_distribution_two_teams_without_reciprocal_pairs():
+    users = [(i, f"User{i}", f"Last{i}") for i in range(1, 21)]
+    teams = {i: i % 2 for i in range(1, 21)}
+
+    for _ in range(10):
+        distribution = create_constrained_distribution(
+            users, k=4, teams=teams, allow_reciprocal=False
+        )
+        is_valid, _ = verify_distribution(distribution, teams=teams, allow_reciprocal=False)
+        assert is_valid
+
+
+@pytest.mark.parametrize(
+    "k, exclusions, teams, allow_reciprocal",
+    [
+        (6, [], {i: i % 2 for i in range(1, 11)}, True),
+        (5, [], None, False),
+        (9, [(1, 2)], None, True),
+        # Команда больше половины: отправителей вне неё не хватит
+        (1, [], {i: "a" for i in range(1, 7)}, True),
+        # Без взаимных пар у каждого 5 человек из другой команды, а нужно 2k
+        (3, [], {i: i % 2 for i in range(1, 11)}, False),
+    ],
+)
+def test_constrained_distribution_reports_infeasible(k, exclusions, teams, allow_reciprocal):
+    users = [(i, f"User{i}", f"Last{i}") for i in range(1, 11)]
+    with pytest.raises(DistributionInfeasibleError):
+        create_constrained_distribution(users, k, exclusions, teams, allow_reciprocal)
+
+
+def test_constrained_distribution_reports_infeasible_after_repair():
+    # Первые 40 участников могут писать только двоим: каждый по отдельности
+    # проходит проверку, но вместе граф не собрать.
+    n, group = 400, 40
+    exclusions = [(a, b) for a in range(group) for b in range(group + 2, n) if a != b]
+    exclusions += [(a, b) for a in range(group) for b in range(group) if a != b]
+    users = [(i, f"User{i}", f"Last{i}") for i in range(n)]
+
+    with pytest.raises(DistributionInfeasibleError):
+        create_constrained_distribution(users, 1, exclusions)
+
+
+def test_verify_reports_constraint_violations():
+    distribution = {1: [2], 2: [3], 3: [1]}
+    assert verify_distribution(distribution)[0]
+
+    is_valid, stats = verify_distribution(distribution, exclusions=[(1, 2)])
+    assert not is_valid
+    assert stats["excluded"] == 1
+
+    is_valid, stats = verify_distribution(distribution, teams={1: "a", 2: "a"})
+    assert not is_valid
+    assert stats["same_team"] == 1
+
+    is_valid, stats = verify_distribution({1: [2], 2: [1]}, allow_reciprocal=False)
+    assert not is_valid
+    assert stats["reciprocal"] == 1
+
+
+def test_extend_distribution_keeps_letters_in_flight(db):
+    users = [(i, f"User{i}", f"Last{i}") for i in range(1, 21)]
+    save_distribution(create_distribution(users, k=3))
+    with connection() as conn:
+        conn.execute("UPDATE distribution SET status = 1 WHERE telegram_id_sender <= 5")
+        conn.execute("UPDATE distribution SET status = 2 WHERE telegram_id_sender = 6")
+        conn.commit()
+    before = get_distribution_rows()
+
+    removed, added = extend_distribution(before, [21, 22], k=3)
+    apply_distribution_changes(removed, added)
+    after = get_distribution_rows()
+
+    assert len(removed) <= 6
+    assert len(added) == len(removed) + 6
+    assert {row for row in before if row[2]} <= set(after)
+
+    distribution = {}
+    for sender, recipient, _ in after:
+        distribution.setdefault(sender, []).append(recipient)
+    is_valid, stats = verify_distribution(distribution)
+    assert is_valid
+    assert stats["total_users"] == 22
+    assert stats["outgoing_count"] == 3
+    assert stats["incoming_count"] == 3
+
+
+def test_extend_distribution_respects_constraints():
+    users = list(range(1, 31))
+    teams = {i: i % 3 for i in range(1, 33)}
+    exclusions = [(i, 31) for i in range(1, 11)] + [(32, i) for i in range(11, 21)]
+    senders, receivers = create_constrained_distribution_array(
+        users, 3, exclusions, teams, allow_reciprocal=False, rng=np.random.default_rng(1)
+    )
+    existing = [
+        (sender, recipient, 0)
+        for sender, row in zip(senders.tolist(), receivers.tolist())
+        for recipient in row
+    ]
+
+    for seed in range(10):
+        removed, added = extend_distribution(
+            existing, [31, 32], 3, np.random.default_rng(seed), exclusions, teams
+        )
+        edges = (set(row[:2] for row in existing) - set(removed)) | set(added)
+        distribution = defaultdict(list)
+        for sender, recipient in edges:
+            distribution[sender].append(recipient)
+        is_valid, stats = verify_distribution(
+            distribution, exclusions, teams, allow_reciprocal=False
+        )
+        assert is_valid, stats
+
+
+def test_extend_distribution_needs_free_pairs():
+    existing = [(1, 2, 1), (2, 3, 1), (3, 1, 1)]
+    with pytest.raises(DistributionInfeasibleError):
+        extend_distribution(existing, [4], k=1)
+
+
+def test_build_distribution_is_reproducible_from_seed():
+    first = build_distribution(range(1, 51), 3, seed=42)
+    second = build_distribution(reversed(range(1, 51)), 3, seed=42)
+    other = build_distribution(range(1, 51), 3, seed=43)
+
+    assert np.array_equal(first[1], second[1])
+    assert not np.array_equal(first[1], other[1])
+
+
+def test_recorded_draw_replays_with_constraints(db):
+    user_ids = list(range(1, 41))
+    constraints = {
+        "exclusions": [(1, 2), (3, 4), (1, 2)],
+        "teams": {i: f"t{i % 4}" for i in user_ids},
+        "allow_reciprocal": False,
+    }
+    senders, receivers = build_distribution(user_ids, 3, 42, constraints)
+    record_draw(42, 3, len(user_ids), None, encode_constraints(constraints), participants_digest(user_ids))
+
+    seed, k, _, _, recorded, participants = get_last_draw()
+    assert participants == participants_digest(reversed(user_ids))
+    assert participants != participants_digest(user_ids + [41])
+    assert recorded == encode_constraints(decode_constraints(recorded))
+    assert decode_constraints(encode_constraints(None)) is None
+
+    rebuilt = build_distribution(user_ids, k, seed, decode_constraints(recorded))
+    assert np.array_equal(rebuilt[0], senders)
+    assert np.array_equal(rebuilt[1], receivers)
+
+
+def test_draw_is_recorded_with_the_saved_distribution(db):
+    senders, receivers = build_distribution(range(1, 11), 3, seed=7)
+    draw = (7, 3, 10, None, encode_constraints(None), participants_digest(range(1, 11)))
+
+    # Повторяющаяся пара валит вставку уже после записи о жеребьёвке
+    with pytest.raises(sqlite3.IntegrityError):
+        save_distribution_array(senders, receivers[:, [0, 0]], draw=draw)
+    assert get_last_draw() is None
+
+    save_distribution_array(senders, receivers, draw=draw)
+    assert get_last_draw()[0] == 7
+    assert get_stats()["distribution.status.0"] == 30
+
+
+def test_check_recorded_constraints():
+    recorded = encode_constraints({"exclusions": [(1, 2)], "teams": {1: "a", 2: "b"}, "allow_reciprocal": True})
+    late = {"exclusions": [(1, 2), (3, 4)], "teams": {1: "a", 2: "b", 3: "a"}, "allow_reciprocal": True}
+
+    assert check_recorded_constraints(None, recorded) == decode_constraints(recorded)
+    assert check_recorded_constraints(late, recorded, allow_additions=True) is late
+    with pytest.raises(ValueError):
+        check_recorded_constraints(late, recorded)
+    with pytest.raises(ValueError):
+        check_recorded_constraints({"teams": {1: "b"}}, recorded, allow_additions=True)
+
+
+def test_same_group_score():
+    score = SameGroupScore({1: "a", 2: "a", 3: "b"})
+    senders = np.array([1, 2, 3])
+    receivers = np.array([[2], [3], [1]])
+    assert score(senders, receivers) == 1.0
+
+
+def test_search_distribution_picks_best_seed():
+    user_ids = list(range(1, 31))
+    score = SameGroupScore({i: i % 3 for i in user_ids})
+
+    seed, best, senders, receivers = search_distribution(
+        user_ids, 4, candidates=8, base_seed=7, score=score, workers=2
+    )
+
+    assert best == score(senders, receivers)
+    rebuilt = build_distribution(user_ids, 4, seed)
+    assert np.array_equal(rebuilt[0], senders)
+    assert np.array_equal(rebuilt[1], receivers)
+    assert verify_distribution_array(senders, receivers)[0]
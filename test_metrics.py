@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+import metrics
+import sql
+from middlewares import HandlerTimingMiddleware
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("latency_seconds", "Задержка", "handler", buckets=(0.1, 1.0))
+    histogram.observe("start", 0.05)
+    histogram.observe("start", 0.1)
+    histogram.observe("start", 3.0)
+
+    assert histogram.render() == [
+        "# HELP latency_seconds Задержка",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{handler="start",le="0.1"} 2',
+        'latency_seconds_bucket{handler="start",le="1.0"} 2',
+        'latency_seconds_bucket{handler="start",le="+Inf"} 3',
+        'latency_seconds_sum{handler="start"} 3.15',
+        'latency_seconds_count{handler="start"} 3',
+    ]
+    assert histogram.quantile("start", 0.5) == 0.1
+    assert histogram.quantile("start", 0.95) == float("inf")
+
+
+def test_handler_timing_middleware():
+    histogram = metrics.Histogram("latency_seconds", "Задержка", "handler")
+
+    async def toggle_recipient(event, data):
+        return "ok"
+
+    middleware = HandlerTimingMiddleware(histogram)
+    data = {"handler": SimpleNamespace(callback=toggle_recipient)}
+    assert asyncio.run(middleware(toggle_recipient, None, data)) == "ok"
+    assert histogram.snapshot()["toggle_recipient"][2] == 1
+
+
+def test_sql_functions_are_counted(db):
+    before = sql.function_stats().get("add_user", (0, 0, 0.0))
+    sql.add_user(1, None, "Иван")
+    sql.add_user(2, None, "Петр")
+    calls, queries, seconds = sql.function_stats()["add_user"]
+
+    # BEGIN и INSERT на каждый вызов
+    assert calls - before[0] == 2
+    assert queries - before[1] == 4
+    assert seconds > before[2]
+    assert 'sql_function_calls_total{function="add_user"}' in metrics.render()
@@ -0,0 +1,43 @@
+import asyncio
+
+from middlewares import ConcurrencyLimitMiddleware
+
+
+def test_concurrency_limit_and_drain():
+    async def scenario():
+        middleware = ConcurrencyLimitMiddleware(2)
+        running = 0
+        peak = 0
+
+        async def handler(event, data):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return event
+
+        tasks = [asyncio.create_task(middleware(handler, i, {})) for i in range(6)]
+        await asyncio.sleep(0)
+        assert middleware.active == 6
+        assert await middleware.drain(1.0)
+        assert [task.result() for task in tasks] == list(range(6))
+        assert peak == 2
+        assert middleware.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_drain_times_out():
+    async def scenario():
+        middleware = ConcurrencyLimitMiddleware(1)
+
+        async def handler(event, data):
+            await asyncio.sleep(1)
+
+        task = asyncio.create_task(middleware(handler, None, {}))
+        await asyncio.sleep(0)
+        assert not await middleware.drain(0.01)
+        task.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import profiling
+
+
+def test_loop_lag_monitor_warns(caplog):
+    async def scenario():
+        monitor = asyncio.create_task(profiling.monitor_loop_lag(50, interval=0.01))
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)
+        await asyncio.sleep(0.02)
+        monitor.cancel()
+
+    with caplog.at_level("WARNING", logger="profiling"):
+        asyncio.run(scenario())
+    assert any("заблокирован" in record.getMessage() for record in caplog.records)
+
+
+def test_profile_can_be_stopped_early():
+    async def busy():
+        while True:
+            sum(range(1000))
+            await asyncio.sleep(0)
+
+    async def scenario():
+        worker = asyncio.create_task(busy())
+        task = asyncio.create_task(profiling.profile(60, top=10))
+        await asyncio.sleep(0.05)
+        assert profiling.is_profiling()
+        with pytest.raises(RuntimeError):
+            await profiling.profile(1)
+        assert profiling.stop_profiling()
+        report = await asyncio.wait_for(task, 5)
+        worker.cancel()
+        return report
+
+    report = asyncio.run(scenario())
+    assert "busy" in report
+    assert not profiling.is_profiling()
+    assert not profiling.stop_profiling()
+
+
+def test_profile_samples_database_thread():
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def slow_query():
+        deadline = time.perf_counter() + 0.2
+        while time.perf_counter() < deadline:
+            sum(range(1000))
+
+    async def scenario():
+        task = asyncio.create_task(profiling.profile(0.5, top=10, executor=executor))
+        await asyncio.sleep(0.05)
+        await asyncio.get_running_loop().run_in_executor(executor, slow_query)
+        return await task
+
+    report = asyncio.run(scenario())
+    executor.shutdown()
+    database = report.split("Поток базы")[1]
+    assert "slow_query" in database
@@ -0,0 +1,48 @@
+import show_distribution
+import sql
+
+
+def add_distribution(rows):
+    with sql.transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO distribution (telegram_id_sender, telegram_id_recipient, status)
+            VALUES (?, ?, ?)
+        """,
+            rows,
+        )
+
+
+def test_iter_distribution_pages_in_key_order(db):
+    for user_id in (1, 2, 3):
+        sql.add_user(user_id, None, f"User{user_id}")
+    rows = [(s, r, 0) for s in (1, 2, 3) for r in (1, 2, 3) if s != r]
+    add_distribution(rows)
+
+    streamed = list(show_distribution.iter_distribution(batch_size=4))
+
+    assert [row[:2] for row in streamed] == [row[:2] for row in rows]
+    assert streamed[0][2:] == ("User1", None, "User2", None)
+
+
+def test_calculate_stats_regular(db):
+    add_distribution([(1, 2, 0), (2, 3, 1), (3, 1, 2)])
+
+    is_valid, stats = show_distribution.calculate_stats()
+
+    assert is_valid
+    assert stats["outgoing_count"] == stats["incoming_count"] == 1
+    assert stats["total_users"] == 3
+    assert stats["statuses"] == {0: 1, 1: 1, 2: 1}
+    assert stats["irregular"] == []
+
+
+def test_calculate_stats_reports_irregular_users(db):
+    add_distribution([(1, 2, 0), (1, 3, 0), (2, 3, 0), (2, 1, 0), (3, 1, 0), (4, 2, 0)])
+
+    is_valid, stats = show_distribution.calculate_stats()
+
+    assert not is_valid
+    assert stats["outgoing_degrees"] == {1: 2, 2: 2}
+    assert stats["total_users"] == 4
+    assert (4, 1, 0) in stats["irregular"]
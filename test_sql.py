@@ -0,0 +1,475 @@
+import asyncio
+import re
+import sqlite3
+import threading
+
+import pytest
+
+import async_sql
+import sql
+
+
+def add_distribution(pairs, status=0):
+    with sql.transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO distribution (telegram_id_sender, telegram_id_recipient, status)
+            VALUES (?, ?, ?)
+        """,
+            [(sender, recipient, status) for sender, recipient in pairs],
+        )
+
+
+def test_connection_is_reused(db):
+    with sql.connection() as first:
+        pass
+    with sql.connection() as second:
+        pass
+    assert first is second
+
+
+def test_connection_uses_wal(db):
+    with sql.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_failed_transaction_is_rolled_back(db):
+    with pytest.raises(RuntimeError):
+        with sql.transaction() as conn:
+            conn.execute("INSERT INTO users (user_id, first_name) VALUES (1, 'Иван')")
+            raise RuntimeError
+    assert sql.get_user_contact(1) == "ID: 1"
+
+
+def test_user_roundtrip(db):
+    sql.add_user(1, "ivan", "Иван", "Иванов")
+    sql.add_user(2, None, "Петр", "Петров")
+    sql.confirm_user(1)
+
+    assert sql.is_confirmed(1)
+    assert not sql.is_confirmed(2)
+    assert sql.get_confirmed_users() == [1]
+    assert sql.get_user_contact(1) == "@ivan"
+    assert sql.get_user_contact(2) == "Петр Петров"
+
+
+def test_contact_cache(db, monkeypatch):
+    sql.add_user(1, "ivan", "Иван")
+    sql.add_user(2, None, "Петр", "Петров")
+    monkeypatch.setattr(sql, "_contact_cache", sql.LRUCache(2))
+
+    assert [sql.get_user_contact(user_id) for user_id in (1, 2, 3)] == ["@ivan", "Петр Петров", "ID: 3"]
+    with sql.transaction() as conn:
+        conn.execute("UPDATE users SET username = 'ivan2' WHERE user_id = 1")
+    assert sql.get_user_contact(1) == "@ivan"
+    assert sql.contact_cache_stats() == {"size": 2, "maxsize": 2, "hits": 1, "misses": 3}
+
+    sql.invalidate_contact(1)
+    assert sql.get_user_contact(1) == "@ivan2"
+    sql.add_user(3, None, "Анна")
+    assert sql.get_user_contact(3) == "Анна"
+    # Кэш ограничен: самый давно использованный контакт вытеснен
+    assert sql.contact_cache_stats()["size"] == 2
+    assert sql._contact_cache.get(2) is None
+
+
+def test_recipient_contacts_by_sender(db):
+    sql.add_user(1, "ivan", "Иван")
+    sql.add_user(2, None, "Петр", "Петров")
+    sql.add_user(3, None, "Анна")
+    for user_id in (1, 2, 3):
+        sql.confirm_user(user_id)
+    add_distribution([(1, 3), (1, 2), (2, 1), (2, 4)])
+
+    assert sql.get_recipient_contacts_by_sender() == [
+        (1, ["Петр Петров", "Анна"]),
+        (2, ["@ivan"]),
+        (3, []),
+    ]
+    assert sql.get_recipient_contacts_by_sender([2, 5]) == [(2, ["@ivan"]), (5, [])]
+
+
+def test_take_letters_for_recipient(db):
+    for user_id in (1, 2, 3):
+        sql.add_user(user_id, None, f"User{user_id}")
+    add_distribution([(1, 3), (2, 3)], status=1)
+
+    assert sorted(sql.take_letters_for_recipient(3)) == [1, 2]
+    assert sql.take_letters_for_recipient(3) == []
+
+
+def test_take_letters_waits_for_concurrent_writer(db):
+    for user_id in (1, 2, 3):
+        sql.add_user(user_id, None, f"User{user_id}")
+    add_distribution([(1, 3), (2, 3)], status=1)
+
+    # Рассылка пишет журнал, пока админ отмечает письма полученными
+    other = sqlite3.connect(sql.DB_NAME, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("INSERT INTO broadcast_log (campaign, chat_id) VALUES ('reminder', 1)")
+    timer = threading.Timer(0.2, other.execute, ("COMMIT",))
+    timer.start()
+    try:
+        assert sorted(sql.take_letters_for_recipient(3)) == [1, 2]
+    finally:
+        timer.join()
+        other.close()
+
+
+def test_async_api_runs_on_db_thread(db, monkeypatch):
+    threads = []
+    original = sql.get_user_contact
+
+    def spy(user_id):
+        threads.append(threading.current_thread().name)
+        return original(user_id)
+
+    monkeypatch.setattr(async_sql, "get_user_contact", async_sql._to_async(spy))
+
+    async def scenario():
+        await async_sql.add_user(1, "ivan", "Иван")
+        return await async_sql.get_user_contact(1)
+
+    assert asyncio.run(scenario()) == "@ivan"
+    assert threads and threads[0].startswith("sql")
+
+
+def test_get_recipient_contacts(db):
+    sql.add_user(1, "sender", "Отправитель")
+    sql.add_user(2, "ivan", "Иван", "Иванов")
+    sql.add_user(3, None, "Петр", "Петров")
+    add_distribution([(1, 2), (1, 3)])
+    sql.update_distribution_status(1, 3, 1)
+
+    assert sorted(sql.get_recipient_contacts(1)) == [
+        (2, "@ivan", 0),
+        (3, "Петр Петров", 1),
+    ]
+    assert sql.get_recipient_contacts(2) == []
+
+
+def test_toggle_distribution_status(db):
+    for user_id in (1, 2, 3):
+        sql.add_user(user_id, None, f"User{user_id}")
+    add_distribution([(1, 2), (1, 3)])
+
+    status, recipients = sql.toggle_distribution_status(1, 2)
+    assert status == 1
+    assert sorted(recipients) == [(2, "User2", 1), (3, "User3", 0)]
+
+    status, recipients = sql.toggle_distribution_status(1, 2)
+    assert status == 0
+    assert sorted(recipients) == [(2, "User2", 0), (3, "User3", 0)]
+
+
+def test_toggle_rejects_received_and_unknown_letters(db):
+    for user_id in (1, 2):
+        sql.add_user(user_id, None, f"User{user_id}")
+    add_distribution([(1, 2)], status=2)
+
+    assert sql.toggle_distribution_status(1, 2) == (None, [])
+    assert sql.toggle_distribution_status(1, 3) == (None, [])
+    assert sql.get_recipient_contacts(1) == [(2, "User2", 2)]
+
+
+def count_commits(func, *args):
+    statements = []
+    with sql.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        result = func(*args)
+    finally:
+        with sql.connection() as conn:
+            conn.set_trace_callback(None)
+    return result, statements.count("COMMIT")
+
+
+@pytest.mark.parametrize("recipients", [1, 10, 200])
+def test_bulk_status_update_commits_once(db, recipients):
+    add_distribution([(1, r) for r in range(2, recipients + 2)])
+
+    updated, commits = count_commits(
+        sql.update_distribution_statuses, 1, list(range(2, recipients + 2)), 1
+    )
+    assert updated == recipients
+    assert commits == 1
+
+    updated, commits = count_commits(sql.set_sender_status, 1, 0)
+    assert updated == recipients
+    assert commits == 1
+
+
+def test_bulk_status_update_is_scoped_to_sender(db):
+    add_distribution([(1, 2), (1, 3), (2, 3)])
+
+    assert sql.update_distribution_statuses(1, [3, 4], 1) == 1
+    assert sql.set_sender_status(5, 1) == 0
+    with sql.connection() as conn:
+        rows = conn.execute(
+            "SELECT telegram_id_sender, telegram_id_recipient, status FROM distribution"
+        ).fetchall()
+    assert sorted(rows) == [(1, 2, 0), (1, 3, 1), (2, 3, 0)]
+
+
+def test_notification_queue(db):
+    assert sql.get_next_notification_due() is None
+
+    add_distribution([(1, 2), (1, 3), (1, 4)], status=1)
+    assert sql.schedule_notifications(1, [(2, 100.0), (3, 50.0), (4, 300.0)]) == 3
+    assert sql.get_next_notification_due() == 50.0
+
+    due = sql.get_due_notifications(200.0, 10)
+    assert [recipient_id for _, recipient_id, _ in due] == [3, 2]
+    assert len(sql.get_due_notifications(200.0, 1)) == 1
+
+    sql.complete_notifications([(notification_id, letters) for notification_id, _, letters in due], 400.0)
+    assert sql.get_due_notifications(200.0, 10) == []
+    assert sql.get_next_notification_due() == 300.0
+
+
+def test_notifications_are_coalesced_per_recipient(db):
+    add_distribution([(1, 2), (1, 3), (4, 2), (5, 2), (6, 2)], status=1)
+    sql.schedule_notifications(1, [(2, 100.0), (3, 50.0)])
+    sql.schedule_notifications(4, [(2, 20.0)])
+    sql.schedule_notifications(5, [(2, 500.0)])
+
+    # Задержка берётся от первого подтверждения, письма суммируются
+    due = sql.get_due_notifications(200.0, 10)
+    assert [(recipient_id, letters) for _, recipient_id, letters in due] == [(3, 1), (2, 3)]
+
+    # Пока уведомление отправлялось, получателю 2 подтвердили ещё одно письмо
+    sql.schedule_notifications(6, [(2, 150.0)])
+    sql.complete_notifications([(notification_id, letters) for notification_id, _, letters in due], 400.0)
+
+    assert [(recipient_id, letters) for _, recipient_id, letters in sql.get_due_notifications(400.0, 10)] == [(2, 1)]
+    assert sql.get_next_notification_due() == 400.0
+
+
+def test_reconfirmed_letters_are_not_counted_again(db):
+    add_distribution([(1, 2), (1, 3)])
+
+    sql.toggle_distribution_status(1, 2)
+    assert sql.schedule_notifications(1, [(2, 100.0)]) == 1
+    sql.toggle_distribution_status(1, 3)
+    assert sql.schedule_notifications(1, [(2, 100.0), (3, 100.0)]) == 1
+
+    due = sql.get_due_notifications(200.0, 10)
+    assert [(recipient_id, letters) for _, recipient_id, letters in due] == [(2, 1), (3, 1)]
+
+    # После отправки повторное подтверждение не ставит уведомление снова
+    sql.complete_notifications([(notification_id, letters) for notification_id, _, letters in due], 400.0)
+    assert sql.schedule_notifications(1, [(2, 100.0), (3, 100.0)]) == 0
+    assert sql.get_next_notification_due() is None
+
+
+def test_failed_notifications_stay_queued(db):
+    add_distribution([(1, 2), (1, 3), (5, 2), (1, 4)], status=1)
+    sql.schedule_notifications(1, [(2, 100.0), (3, 50.0)])
+    sql.schedule_notifications(5, [(2, 100.0)])
+    (sent_id, _, sent_letters), (failed_id, _, _) = sql.get_due_notifications(200.0, 10)
+
+    sql.complete_notifications([(sent_id, sent_letters)], 400.0)
+    assert sql.postpone_notifications([(failed_id, 260.0)], 2) == 0
+
+    assert sql.get_due_notifications(200.0, 10) == []
+    assert sql.get_due_notifications(300.0, 10) == [(failed_id, 2, 2)]
+
+    # Вторая неудача исчерпывает попытки
+    assert sql.postpone_notifications([(failed_id, 500.0)], 2) == 1
+    assert sql.get_next_notification_due() is None
+
+    # Получатель заблокировал бота: повторять бесполезно
+    sql.schedule_notifications(1, [(4, 100.0)])
+    sql.delete_notifications([notification_id for notification_id, _, _ in sql.get_due_notifications(200.0, 10)])
+    assert sql.get_next_notification_due() is None
+
+
+def test_migrations_upgrade_legacy_database(tmp_path, monkeypatch):
+    db_name = str(tmp_path / "legacy.db")
+    legacy = sqlite3.connect(db_name)
+    legacy.executescript("""
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            confirmed BOOLEAN DEFAULT 0
+        );
+        CREATE TABLE distribution (
+            telegram_id_sender INTEGER NOT NULL,
+            telegram_id_recipient INTEGER NOT NULL,
+            status INTEGER DEFAULT 0,
+            PRIMARY KEY (telegram_id_sender, telegram_id_recipient)
+        );
+        INSERT INTO users (user_id, username, first_name, confirmed) VALUES (1, 'ivan', 'Иван', 1);
+        INSERT INTO distribution VALUES (1, 1, 2);
+        CREATE TABLE notifications (
+            id INTEGER PRIMARY KEY,
+            recipient_id INTEGER NOT NULL,
+            due_at REAL NOT NULL
+        );
+        INSERT INTO notifications (recipient_id, due_at) VALUES (1, 30.0), (2, 10.0), (1, 20.0);
+    """)
+    legacy.close()
+    monkeypatch.setattr(sql, "DB_NAME", db_name)
+
+    try:
+        assert sql.migrate() == len(sql.MIGRATIONS)
+        assert sql.migrate() == len(sql.MIGRATIONS)
+        assert sql.get_confirmed_users() == [1]
+        assert sql.get_recipient_contacts(1) == [(1, "@ivan", 2)]
+        assert sql.get_stats() == {"users.confirmed.1": 1, "distribution.status.2": 1}
+        assert sql.get_due_notifications(100.0, 10) == [(2, 2, 1), (1, 1, 2)]
+        # Забранное письмо уже не должно ставить уведомление
+        assert sql.schedule_notifications(1, [(1, 100.0)]) == 0
+    finally:
+        sql.close_connections()
+
+
+def test_migrations_can_stop_at_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(sql, "DB_NAME", str(tmp_path / "users.db"))
+    try:
+        assert sql.migrate(1) == 1
+        assert sql.migrate() == len(sql.MIGRATIONS)
+        with sql.connection() as conn:
+            assert sql.get_schema_version(conn) == len(sql.MIGRATIONS)
+    finally:
+        sql.close_connections()
+
+
+def test_stats_follow_table_changes(db):
+    for user_id in (1, 2, 3):
+        sql.add_user(user_id, None, f"User{user_id}")
+    sql.add_user(1, None, "User1")
+    sql.confirm_user(1)
+    sql.confirm_user(1)
+    add_distribution([(1, 2), (1, 3), (2, 1), (3, 1)])
+
+    sql.toggle_distribution_status(1, 2)
+    sql.update_distribution_statuses(2, [1], 1)
+    sql.take_letters_for_recipient(1)
+    with sql.transaction() as conn:
+        conn.execute("DELETE FROM distribution WHERE telegram_id_sender = 3")
+        conn.execute("DELETE FROM users WHERE user_id = 3")
+
+    stats = sql.get_stats()
+    with sql.connection() as conn:
+        for status, count in conn.execute(
+            "SELECT status, COUNT(*) FROM distribution GROUP BY status"
+        ):
+            assert stats[f"distribution.status.{status}"] == count
+    assert stats["distribution.status.0"] == 1
+    assert stats["distribution.status.1"] == 1
+    assert stats["distribution.status.2"] == 1
+    assert stats["users.confirmed.1"] == 1
+    assert stats["users.confirmed.0"] == 1
+
+
+def test_pending_letters_pages(db):
+    for user_id in range(1, 6):
+        sql.add_user(user_id, None, f"User{user_id}")
+    pairs = [(s, r) for s in range(1, 6) for r in range(1, 6) if s != r]
+    add_distribution(pairs, status=1)
+    keys = lambda rows: [(row[0], row[4]) for row in rows]
+
+    first, has_next = sql.get_pending_letters_page(limit=8)
+    assert keys(first) == pairs[:8] and has_next
+    second, has_next = sql.get_pending_letters_page(keys(first)[-1], limit=8)
+    assert keys(second) == pairs[8:16] and has_next
+    last, has_next = sql.get_pending_letters_page(keys(second)[-1], limit=8)
+    assert keys(last) == pairs[16:] and not has_next
+
+    back, has_prev = sql.get_pending_letters_page(keys(last)[0], backward=True, limit=8)
+    assert keys(back) == pairs[8:16] and has_prev
+    back, has_prev = sql.get_pending_letters_page(keys(back)[0], backward=True, limit=8)
+    assert keys(back) == pairs[:8] and not has_prev
+
+    rows, _ = sql.get_pending_letters_page((2, 1), recipient_id=3)
+    assert keys(rows) == [(4, 3), (5, 3)]
+    rows, _ = sql.get_pending_letters_page((2, 3), backward=True, sender_id=2)
+    assert keys(rows) == [(2, 1)]
+
+
+def test_slow_query_log(db, monkeypatch, caplog):
+    monkeypatch.setattr(sql, "SLOW_QUERY_MS", 0.0)
+    with caplog.at_level("WARNING", logger="sql.slow"):
+        sql.add_user(1, "ivan", "Иван")
+        add_distribution([(1, 2), (1, 3)])
+        sql.update_distribution_statuses(1, [2, 3], 1)
+        sql.schedule_notifications(1, [(2, 1.0), (3, 2.0)])
+
+    messages = [record.getMessage() for record in caplog.records]
+    insert = next(m for m in messages if "INSERT OR IGNORE INTO users" in m)
+    assert "в add_user" in insert
+    assert "(int, str[4], str[4], NoneType)" in insert
+    assert "ivan" not in insert
+    assert any("в update_distribution_statuses" in m and "str[6]" in m for m in messages)
+    assert any("2 x (int, float)" in m for m in messages)
+
+    caplog.clear()
+    monkeypatch.setattr(sql, "SLOW_QUERY_MS", 10_000.0)
+    sql.get_user_contact(1)
+    assert not caplog.records
+
+
+def trace_statements(func, *args):
+    statements = []
+    with sql.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        func(*args)
+    finally:
+        with sql.connection() as conn:
+            conn.set_trace_callback(None)
+    return [
+        statement
+        for statement in statements
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE")
+    ]
+
+
+HOT_QUERIES = [
+    (sql.is_confirmed, (1,)),
+    (sql.get_confirmed_users, ()),
+    (sql.get_user_contact, (1,)),
+    (sql.get_recipient_contacts_by_sender, ()),
+    (sql.get_recipient_contacts_by_sender, ([1, 2],)),
+    (sql.get_recipient_contacts, (1,)),
+    (sql.toggle_distribution_status, (1, 2)),
+    (sql.update_distribution_statuses, (1, [2, 3], 1)),
+    (sql.set_sender_status, (1, 0)),
+    (sql.take_letters_for_recipient, (2,)),
+    (sql.get_pending_letters_page, ((1, 2),)),
+    (sql.get_pending_letters_page, ((1, 2), True, 20, 1)),
+    (sql.get_pending_letters_page, ((1, 2), False, 20, None, 2)),
+    (sql.schedule_notifications, (1, [(2, 0.0)])),
+    (sql.get_due_notifications, (0.0, 10)),
+    (sql.get_next_notification_due, ()),
+    (sql.complete_notifications, ([(1, 1)], 0.0)),
+    (sql.postpone_notifications, ([(1, 0.0)], 3)),
+    (sql.delete_notifications, ([1],)),
+    (sql.get_campaign_chats, ("reminder", ["sent"])),
+    (sql.record_delivery, ("reminder", 1, "sent")),
+]
+
+
+@pytest.mark.parametrize(
+    "func, args", HOT_QUERIES, ids=[func.__name__ for func, _ in HOT_QUERIES]
+)
+def test_hot_queries_do_not_scan_tables(db, func, args):
+    sql.add_user(1, None, "User1")
+    sql.add_user(2, None, "User2")
+    add_distribution([(1, 2), (2, 1)])
+
+    statements = trace_statements(func, *args)
+    assert statements
+
+    with sql.connection() as conn:
+        for statement in statements:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+            for *_, detail in plan:
+                # SCAN без индекса по обычной таблице означает полный проход.
+                match = re.match(r"SCAN (\w+)(.*)", detail)
+                if match and match.group(1) != "json_each":
+                    assert "INDEX" in match.group(2), f"{statement}: {detail}"